@@ -2,11 +2,15 @@ from builtins import range, str, object
 from future.utils import iteritems
 
 import re
+import copy
+import types
 import inspect
 from operator import add
 from collections import OrderedDict, defaultdict
 from functools import reduce
 
+import numpy as np
+
 from peri import util
 
 class NotAParameterError(Exception):
@@ -256,6 +260,28 @@ class Component(ParameterGroup, util.CompatibilityPatch):
         """
         pass
 
+    def get_field_gradient(self, param):
+        """
+        Analytic derivative of the field (as returned by `get` over the
+        entire shape) with respect to a single parameter `param`. Components
+        which can provide this return it, otherwise None is returned and the
+        derivative must be found by finite differences.
+
+        Parameters
+        -----------
+        param : string
+            The parameter with which to differentiate
+
+        Returns
+        -------
+        tile, dfield : :class:`~peri.util.Tile`, ndarray or None
+            The region of the field which depends on `param` and the
+            derivative of the field over that region (of shape `tile.shape`).
+            For components which are operators (the psf), `dfield` is instead
+            the derivative operator, a function of the field it acts on.
+        """
+        return None
+
     def set_tile(self, tile):
         """ Set the currently active tile region for the calculation """
         self.tile = tile
@@ -307,9 +333,40 @@ class Component(ParameterGroup, util.CompatibilityPatch):
         else:
             self.update(params, values)
 
+    def clone(self):
+        """
+        A copy of the component which may be updated independently of this
+        one, made without initializing it again. Arrays and containers are
+        copied since updates change them in place, everything else (tiles,
+        interpolants, sparse operators, ...) is read-only and shared.
+        """
+        obj = self.__class__.__new__(self.__class__)
+        for k, v in iteritems(self.__dict__):
+            obj.__dict__[k] = _clone_attr(v, self, obj)
+        return obj
+
     def __call__(self, *args, **kwargs):
         return self.execute(*args, **kwargs)
 
+def _clone_attr(value, old, new):
+    """ Copy of an attribute of `old` for its clone `new`, see `clone` """
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, util.TileCache):
+        return util.TileCache(value.max_size)
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        # caches are often dicts of dicts (memoize), copy one more level
+        out = copy.copy(value)
+        for k, v in iteritems(value):
+            if isinstance(v, dict):
+                out[k] = copy.copy(v)
+        return out
+    if isinstance(value, types.MethodType) and value.__self__ is old:
+        return types.MethodType(value.__func__, new)
+    return value
+
 class GlobalScalar(Component):
     def __init__(self, name, value, shape=None):
         self.shape = shape
@@ -393,6 +450,13 @@ class ComponentCollection(Component):
         for c in self.comps:
             c.initialize()
 
+    def clone(self):
+        obj = super(ComponentCollection, self).clone()
+        obj.comps = [c.clone() for c in self.comps]
+        obj.setup_params()
+        obj.setup_passthroughs()
+        return obj
+
     def setup_params(self):
         pmap = defaultdict(set)
         lmap = defaultdict(list)
@@ -524,6 +588,13 @@ class ComponentCollection(Component):
         fields = [c.get() for c in self.comps]
         return self.field_reduce_func(fields)
 
+    def get_field_gradient(self, param):
+        """ Pass the gradient along when the fields are simply summed """
+        comps = self.affected_components(param)
+        if len(comps) != 1 or self.field_reduce_func is not reduce_add:
+            return None
+        return comps[0].get_field_gradient(param)
+
     def set_tile(self, tile):
         """ Set the current working tile for components """
         for c in self.comps:
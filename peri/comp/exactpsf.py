@@ -1,13 +1,20 @@
 from builtins import range
 from future.utils import iteritems
 
+import os
+import shutil
+import hashlib
+import tempfile
 import warnings
+import threading
+import multiprocessing
 import numpy as np
 import scipy.ndimage as nd
 
+from functools import partial
 from collections import OrderedDict
 
-from peri import util, interpolation
+from peri import util, interpolation, conf
 from peri.comp import psfs, psfcalc
 from peri.fft import fft, fftkwargs
 
@@ -18,10 +25,62 @@ def moment(p, v, order=1):
     elif order == 2:
         return np.sqrt( ((v**2)*p).sum() - (v*p).sum()**2 )
 
+try:
+    _mp = multiprocessing.get_context('fork')
+except (AttributeError, ValueError):
+    _mp = multiprocessing
+
+# pools of forked processes for the psf slices by number of processes, made
+# once (from the main thread) and reused
+_slice_pools = {}
+
+def _slice_pool(processes):
+    if processes not in _slice_pools:
+        _slice_pools[processes] = _mp.Pool(processes)
+    return _slice_pools[processes]
+
+def _calc_psf_slices(args):
+    """
+    Calculates the psf slices at heights `zs` of the psf of class `cls` with
+    attributes `state` (those which are pickled, see `ExactPSF.psf_slices`)
+    """
+    cls, state, zs, size = args
+    psf = cls.__new__(cls)
+    psf.__dict__.update(state)
+    return psf.psf_slices(zs, size, processes=1)
+
 #=============================================================================
 # The actual interfaces that can be used in the peri system
 #=============================================================================
 class ExactPSF(psfs.PSF):
+    # ceiling in bytes on the padded k-space kernels kept between executions
+    kcache_bytes = 2**28
+
+    # number of processes over which the z slices of the PSF are calculated
+    slice_processes = 1
+
+    # version of the psf calculation in the keys of the on-disk psf cache,
+    # to be incremented whenever a change alters the cached arrays
+    cache_version = 1
+
+    # attributes that determine the psf besides its parameters and the
+    # arguments of psffunc, which key the on-disk psf cache
+    cache_attributes = (
+        'pxsize', 'support_factor', 'measurement_iterations', 'cutoffval',
+        'cutbyval', 'cutfallrate', 'cutedgeval', 'zrange'
+    )
+
+    # size of the psf slices in which the drift is measured
+    drift_measurement_size = 31
+
+    # relative change of the parameters since the psf was characterized
+    # beyond which its support, or only its drift, are measured again. below
+    # these the support and drift are kept, so that small steps such as
+    # finite differences do not change the shape of the psf. by default the
+    # drift is measured again for any change.
+    support_tolerance = 1e-3
+    drift_tolerance = 0.
+
     def __init__(self, shape=None, zrange=None, laser_wavelength=0.488,
             zslab=0., zscale=1.0, kfki=0.889, n2n1=1.44/1.518, alpha=1.173,
             polar_angle=0., pxsize=0.125, support_factor=2, normalize=False,
@@ -147,6 +206,8 @@ class ExactPSF(psfs.PSF):
         self.use_J1 = use_J1
 
         self.do_pinhole = do_pinhole
+        self._kclear()
+        self._kstats = {'hits': 0, 'misses': 0}
 
         if self.sigkf is not None:
             self.nkpts = self.nkpts or 3
@@ -308,6 +369,34 @@ class ExactPSF(psfs.PSF):
 
         return psf, vec
 
+    def psf_slices(self, zs, size, processes=None):
+        """
+        Calculates the psf slices at the z pixel heights `zs`, each offset by
+        its drift, as a list. The slices are split over `processes` forked
+        processes, by default `slice_processes`, which are only used from
+        the main thread. Each process gets the pickled attributes of the psf.
+        """
+        zs = list(zs)
+        processes = min(processes or self.slice_processes, len(zs))
+        if threading.current_thread() is not threading.main_thread():
+            processes = 1
+
+        if processes <= 1:
+            return [
+                self.psf_slice(z, size=size, zoffset=self.drift(z))[0]
+                for z in zs
+            ]
+
+        state = self.__dict__.copy()
+        util.cdd(state, self.nopickle())
+
+        chunks = [list(c) for c in np.array_split(zs, processes)]
+        results = _slice_pool(processes).map(
+            _calc_psf_slices,
+            [(self.__class__, state, c, size) for c in chunks]
+        )
+        return [psf for result in results for psf in result]
+
     def todict(self):
         return {k:self.params[i] for i,k in enumerate(self.params)}
 
@@ -341,6 +430,37 @@ class ExactPSF(psfs.PSF):
             psize = [moment(psf, j, order=2) for j in vec]
         return np.array(psize), drift
 
+    def measure_drift_poly(self):
+        """ Measure the drift polynomial alone for the current parameters """
+        l,u = max(self.zrange[0], self.param_dict['psf-zslab']), self.zrange[1]
+
+        size_l, drift_l = self.measure_size_drift(l, size=self.drift_measurement_size)
+        size_u, drift_u = self.measure_size_drift(u, size=self.drift_measurement_size)
+        return np.polyfit([l, u], [drift_l, drift_u], 1)
+
+    def _moved(self, values):
+        """
+        The largest change of the parameters from the dictionary `values`,
+        relative to their magnitude (or to one for smaller magnitudes)
+        """
+        if values is None:
+            return np.inf
+        v0 = np.array([values[p] for p in self.params])
+        return np.max(np.abs(np.array(self.values) - v0) / np.maximum(np.abs(v0), 1))
+
+    def recharacterize_psf(self):
+        """
+        Characterize the psf again, or measure only its drift again, if the
+        parameters have moved beyond `support_tolerance`, `drift_tolerance`
+        since they were last measured.
+        """
+        if self._moved(self._support_values) > self.support_tolerance:
+            self.characterize_psf()
+            self._support_values = self._drift_values = self.param_dict.copy()
+        elif self._moved(self._drift_values) > self.drift_tolerance:
+            self.drift_poly = self.measure_drift_poly()
+            self._drift_values = self.param_dict.copy()
+
     def characterize_psf(self):
         """ Get support size and drift polynomial for current set of params """
         # there may be an issue with the support and characterization--
@@ -348,8 +468,8 @@ class ExactPSF(psfs.PSF):
         # as the calculated psf.
         l,u = max(self.zrange[0], self.param_dict['psf-zslab']), self.zrange[1]
 
-        size_l, drift_l = self.measure_size_drift(l)
-        size_u, drift_u = self.measure_size_drift(u)
+        size_l, drift_l = self.measure_size_drift(l, size=self.drift_measurement_size)
+        size_u, drift_u = self.measure_size_drift(u, size=self.drift_measurement_size)
 
         # must be odd for now or have a better system for getting the center
         self.support = util.oddify(2*self.support_factor*size_u.astype('int'))
@@ -365,18 +485,97 @@ class ExactPSF(psfs.PSF):
     def get_padding_size(self, tile, z=None):
         return util.Tile(self.support)
 
+    def initialize(self):
+        # the psf cache directory is looked up once rather than every update
+        self._cachedir = conf.get_psf_cache()
+        self.update_values(self.params, self.values)
+        self._support_values = self._drift_values = None
+        self.calculate_psf(save=True)
+        self.set_tile(self.shape)
+
     def update(self, params, values):
         self.update_values(params, values)
-        self.characterize_psf()
+        self.calculate_psf()
+        return True
+
+    def calculate_psf(self, save=False):
+        """
+        Calculates the psf slices for the current parameters, or loads them
+        from the on-disk psf cache (see :mod:`peri.conf`) if they are there.
+        If `save`, newly calculated slices are stored in the cache.
+        """
+        cached = self._load_cache(['slices', 'support', 'drift_poly'])
+        if cached:
+            self.slices, self.support, self.drift_poly = cached
+            self._support_values = self._drift_values = self.param_dict.copy()
+        else:
+            self.recharacterize_psf()
+            zs = range(self.zrange[0], self.zrange[1]+1)
+            self.slices = np.array(self.psf_slices(zs, self.support))
 
-        self.slices = []
-        for i in range(self.zrange[0], self.zrange[1]+1):
-            zdrift = self.drift(i)
-            psf, vec = self.psf_slice(i, size=self.support, zoffset=zdrift)
-            self.slices.append(psf)
+            if save:
+                self._save_cache(slices=self.slices, support=self.support,
+                        drift_poly=self.drift_poly)
+        self._kclear()
 
-        self.slices = np.array(self.slices)
-        return True
+    def _cache_path(self):
+        """
+        The directory of the current psf in the on-disk psf cache, named by a
+        hash of the `cache_version`, class, parameters, arguments of psffunc
+        and `cache_attributes`, or None if the cache is disabled
+        """
+        cachedir = self._cachedir
+        if not cachedir:
+            return None
+
+        def items(d):
+            return [(k, np.array(v).tolist()) for k, v in sorted(iteritems(d))]
+
+        attrs = {k: getattr(self, k, None) for k in self.cache_attributes}
+        key = repr((
+            self.cache_version, self.__class__.__name__,
+            items(self.param_dict), items(self.pack_args()), items(attrs)
+        )).encode('utf-8')
+        return os.path.join(cachedir, hashlib.sha1(key).hexdigest())
+
+    def _load_cache(self, names):
+        """
+        Arrays `names` of the current psf from the on-disk psf cache, the
+        large ones memory-mapped, or None if they are not in the cache
+        """
+        path = self._cache_path()
+        if path is None or not os.path.isdir(path):
+            return None
+
+        try:
+            return [
+                np.load(os.path.join(path, name+'.npy'),
+                    mmap_mode='r' if name in ['slices', 'coefficients'] else None)
+                for name in names
+            ]
+        except (IOError, ValueError):
+            return None
+
+    def _save_cache(self, **arrays):
+        """
+        Stores `arrays` for the current psf in the on-disk psf cache, writing
+        to a temporary directory first so readers never see partial entries
+        """
+        path = self._cache_path()
+        if path is None or os.path.isdir(path):
+            return
+
+        cachedir = os.path.dirname(path)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        tmp = tempfile.mkdtemp(dir=cachedir)
+        try:
+            for name, arr in iteritems(arrays):
+                np.save(os.path.join(tmp, name+'.npy'), np.asarray(arr))
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
 
     def update_values(self, params, values):
         self.set_values(params, values)
@@ -401,11 +600,43 @@ class ExactPSF(psfs.PSF):
         if not hasattr(self, 'tile') or (self.tile != tile).any():
             self.tile = tile
 
-    def _kpad(self, field, finalshape, zpad=False, norm=True):
+    def _kclear(self):
+        """ Empty the k-space kernel cache """
+        self._kcache = OrderedDict()
+        self._kbytes = 0
+
+    def _kcached(self, key, func):
+        """
+        Return the k-space kernel stored under `key`, calculating it with
+        `func()` when it is missing. The cache is least recently used, limited
+        to `kcache_bytes` and emptied whenever the parameters are updated.
+        """
+        if key in self._kcache:
+            self._kstats['hits'] += 1
+            self._kcache.move_to_end(key)
+            return self._kcache[key]
+
+        self._kstats['misses'] += 1
+        kernel = self._kcache[key] = func()
+        self._kbytes += kernel.nbytes
+        while len(self._kcache) > 1 and self._kbytes > self.kcache_bytes:
+            self._kbytes -= self._kcache.popitem(last=False)[1].nbytes
+        return kernel
+
+    def kcache_info(self):
+        """
+        Statistics of the k-space kernel cache as a dictionary of the number
+        of `hits`, `misses`, stored `kernels` and their total `bytes`
+        """
+        return dict(
+            self._kstats, kernels=len(self._kcache), bytes=self._kbytes
+        )
+
+    def _kpad(self, field, finalshape, zpad=False, norm=True, axes=None):
         """
         fftshift and pad the field with zeros until it has size finalshape.
         if zpad is off, then no padding is put on the z direction. returns
-        the fourier transform of the field
+        the fourier transform of the field over `axes` (by default all)
         """
         currshape = np.array(field.shape)
 
@@ -421,55 +652,58 @@ class ExactPSF(psfs.PSF):
         if not zpad:
             o[0] = 0
 
-        axes = None
         pad = tuple((d[i]+o[i],d[i]) for i in [0,1,2])
         rpsf = np.pad(field, pad, mode='constant', constant_values=0)
         rpsf = np.fft.ifftshift(rpsf, axes=axes)
-        kpsf = fft.rfftn(rpsf, **fftkwargs)
+        kpsf = fft.rfftn(rpsf, axes=axes, **fftkwargs)
 
         if norm:
-            kpsf /= kpsf[0,0,0]
+            kpsf /= rpsf.sum()
         return kpsf
 
+    def _kslice(self, zslice, shape):
+        """
+        The psf slice `zslice` padded to the x-y `shape` and transformed in
+        x-y only, with its planes in reverse order for the sum over z
+        """
+        fs = np.array((self.slices[zslice].shape[0],) + tuple(shape))
+        kpsf = self._kpad(self.slices[zslice], fs, norm=True, axes=(1,2))
+        return np.ascontiguousarray(kpsf[::-1])
+
     def execute(self, field):
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
 
-        outfield = np.zeros_like(field, dtype='float')
         zc,yc,xc = self.tile.coords(form='flat')
 
-        # here's the plan. we are going to rotate the field so that the current
-        # plane of interest is in the center. we then crop the image to the
-        # size of the support so that we are only convolving a small region.
-        # finally, take the mid plane back out as the solution.
-        for i,z in enumerate(zc):
-            # pad the psf slice for the convolution
-            fs = np.array(self.tile.shape)
-            fs[0] = self.support[0]
+        # overlap-save in z: the field is transformed in x-y once, and each
+        # plane of the output is the sum over the support in z of the field
+        # planes times the psf planes for that z, periodic in z over the tile
+        kshape = field.shape[1:]
+        kfield = fft.rfftn(field, axes=(1,2), **fftkwargs)
+        koutfield = np.zeros_like(kfield)
 
+        window = np.arange(self.support[0], dtype='int') - int(self.support[0])//2
+        for i,z in enumerate(zc):
             if z < self.zrange[0] or z > self.zrange[1]:
                 continue
 
-            zslice = int(np.clip(z, *self.zrange) - self.zrange[0])
-            middle = field.shape[0]//2
-
-            subpsf = self._kpad(self.slices[zslice], fs, norm=True)
-            subfield = np.roll(field, middle - i, axis=0)
-            subfield = subfield[middle-fs[0]//2:middle+fs[0]//2+1]
-
-            kshape = subfield.shape
-            kfield = fft.rfftn(subfield, **fftkwargs)
+            zslice = int(z - self.zrange[0])
+            kpsf = self._kcached(
+                (zslice, kshape), lambda: self._kslice(zslice, kshape)
+            )
+            planes = (i + window) % field.shape[0]
+            koutfield[i] = np.einsum('zyx,zyx->yx', kfield[planes], kpsf)
 
-            outfield[i] = np.real(fft.irfftn(kfield * subpsf, s=kshape, **fftkwargs))[self.support[0]//2]
-
-        return outfield
+        return fft.irfftn(koutfield, s=kshape, axes=(1,2), **fftkwargs)
 
     def nopickle(self):
         return super(ExactPSF, self).nopickle() + [
             '_rx', '_ry', '_rz', '_rlen',
             '_memoize_clear', '_memoize_caches',
             'rpsf', 'kpsf',
-            'cheb', 'slices'
+            'cheb', 'slices', '_kcache', '_kbytes', '_kstats', '_dcoefficients',
+            '_support_values', '_drift_values', '_cachedir'
         ]
 
     def __getstate__(self):
@@ -480,6 +714,8 @@ class ExactPSF(psfs.PSF):
     def __setstate__(self, idict):
         self.__dict__.update(idict)
         self.patch({'global_zscale': False})
+        self._kclear()
+        self._kstats = {'hits': 0, 'misses': 0}
         if self.shape:
             self.initialize()
 
@@ -827,6 +1063,16 @@ class ExactPinholeConfocalPSF(ExactPSF):
         return vls / vls.sum()
 
 class ChebyshevPSF(ExactPSF):
+    # ceiling in bytes on the size of the products inverted by one irfftn
+    kbatch_bytes = 2**27
+
+    # provide the derivative of the psf wrt its parameters through the
+    # derivatives of the Chebyshev coefficients, see `get_field_gradient`
+    coefficient_gradient = False
+    coefficient_dl = 2e-5
+
+    cache_attributes = ExactPSF.cache_attributes + ('cheb_degree', 'cheb_evals')
+
     def __init__(self, cheb_degree=6, cheb_evals=8, *args, **kwargs):
         """
         Same as ExactPSF, except that the convolution is performed in
@@ -851,22 +1097,95 @@ class ChebyshevPSF(ExactPSF):
 
         super(ChebyshevPSF, self).__init__(*args, **kwargs)
 
-    def update(self, params, values):
-        self.update_values(params, values)
-        self.characterize_psf()
+    def calculate_psf(self, save=False):
+        """
+        Calculates the Chebyshev coefficients for the current parameters, or
+        loads them from the on-disk psf cache, see
+        :func:`~peri.comp.exactpsf.ExactPSF.calculate_psf`
+        """
+        cached = self._load_cache(['coefficients', 'support', 'drift_poly'])
+        coefficients = None
+        if cached:
+            coefficients, self.support, self.drift_poly = cached
+            self._support_values = self._drift_values = self.param_dict.copy()
+        else:
+            self.recharacterize_psf()
 
         self.cheb = interpolation.ChebyshevInterpolation1D(self.psf, window=self.zrange,
-                        degree=self.cheb_degree, evalpts=self.cheb_evals)
-        return True
+                        degree=self.cheb_degree, evalpts=self.cheb_evals,
+                        coefficients=coefficients)
+
+        if save and not cached:
+            self._save_cache(coefficients=self.cheb.coefficients,
+                    support=self.support, drift_poly=self.drift_poly)
+        self._kclear()
+        self._dcoefficients = {}
+
+    def coefficient_derivative(self, param):
+        """
+        Derivative of the Chebyshev coefficients wrt `param`, a forward
+        difference of step `coefficient_dl`. Only the drift is measured again
+        for the step (as limited by `drift_tolerance`), the support is kept,
+        and the psf is evaluated at the Chebyshev points alone. Kept until the
+        psf is next updated.
+        """
+        if param not in self._dcoefficients:
+            dl = self.coefficient_dl
+            value, drift_poly = self.get_values(param), self.drift_poly
+            try:
+                self.set_values(param, value + dl)
+                if self._moved(self._drift_values) > self.drift_tolerance:
+                    self.drift_poly = self.measure_drift_poly()
+                cheb = interpolation.ChebyshevInterpolation1D(self.psf,
+                        window=self.zrange, degree=self.cheb_degree,
+                        evalpts=self.cheb_evals)
+            finally:
+                self.set_values(param, value)
+                self.drift_poly = drift_poly
+
+            self._dcoefficients[param] = (
+                (cheb.coefficients - self.cheb.coefficients) / dl
+            )
+        return self._dcoefficients[param]
+
+    def get_field_gradient(self, param):
+        """
+        If `coefficient_gradient`, the derivative of the psf wrt `param` as
+        the convolution with the derivative of its Chebyshev coefficients
+        (see `coefficient_derivative`), otherwise None.
+        """
+        if not self.coefficient_gradient or param not in self.params:
+            return None
+        return self.shape, partial(self._convolve, param=param)
+
+    def _kcoefficients(self, shape, param=None):
+        """
+        The Chebyshev coefficients (or their derivative wrt `param`) padded
+        to `shape` and transformed to k-space, stacked along the first axis
+        and cached per tile shape.
+        """
+        def calc():
+            if param is None:
+                coeffs = self.cheb.coefficients
+            else:
+                coeffs = self.coefficient_derivative(param)
+            return np.array([
+                self._kpad(c, finalshape=np.array(shape), zpad=True, norm=False)
+                for c in coeffs
+            ])
+        return self._kcached((param, tuple(shape)), calc)
 
     def psf(self, z):
-        psf = []
-        for i in z:
-            p, _ = self.psf_slice(i, size=self.support, zoffset=self.drift(i))
-            psf.append(p)
+        psf = self.psf_slices(z, self.support)
         return np.rollaxis(np.array(psf), 0, 4)
 
     def execute(self, field):
+        return self._convolve(field)
+
+    def _convolve(self, field, param=None):
+        """
+        Convolve `field` with the psf, or with its derivative wrt `param`
+        """
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
 
@@ -875,11 +1194,17 @@ class ChebyshevPSF(ExactPSF):
 
         kshape = field.shape
         kfield = fft.rfftn(field, **fftkwargs)
-        for k,c in enumerate(self.cheb.coefficients):
-            pad = self._kpad(c, finalshape=self.tile.shape, zpad=True, norm=False)
-            cov = np.real(fft.irfftn(kfield * pad, s=kshape, **fftkwargs))
-
-            outfield += self.cheb.tk(k, zc)[:,None,None] * cov
+        kcoeffs = self._kcoefficients(kshape, param=param)
+
+        # invert as many kernels at once as fit in the batch size
+        tks = np.array([self.cheb.tk(k, zc) for k in range(len(kcoeffs))])
+        step = max(1, int(self.kbatch_bytes // kcoeffs[0].nbytes))
+        for k in range(0, len(kcoeffs), step):
+            cov = fft.irfftn(
+                kfield[None] * kcoeffs[k:k+step], s=kshape, axes=(1,2,3),
+                **fftkwargs
+            )
+            outfield += np.einsum('kz,kzyx->zyx', tks[k:k+step], np.real(cov))
 
         return outfield
 
@@ -888,6 +1213,8 @@ class ChebyshevPSF(ExactPSF):
                 self.cheb_evals])
 
 class FixedSSChebPSF(ChebyshevPSF):
+    cache_attributes = ChebyshevPSF.cache_attributes + ('support',)
+
     def __init__(self, support_size=[35,17,25], *args, **kwargs):
         """
         ChebyshevPSF with a fixed support size
@@ -902,12 +1229,11 @@ class FixedSSChebPSF(ChebyshevPSF):
 
     def characterize_psf(self):
         """ Get support size and drift polynomial for current set of params """
-        l,u = max(self.zrange[0], self.param_dict['psf-zslab']), self.zrange[1]
-
-        size_l, drift_l = self.measure_size_drift(l, size=self.support)
-        size_u, drift_u = self.measure_size_drift(u, size=self.support)
+        self.drift_poly = self.measure_drift_poly()
 
-        self.drift_poly = np.polyfit([l, u], [drift_l, drift_u], 1)
+    @property
+    def drift_measurement_size(self):
+        return self.support
 
     def __str__(self):
         return "{} {}".format(self.__class__.__name__, self.support)
@@ -6,6 +6,7 @@ from numpy.polynomial.polynomial import polyval3d
 from numpy.polynomial.legendre import legval
 from numpy.polynomial.chebyshev import chebval
 import scipy.optimize as opt
+from scipy import sparse
 
 from collections import OrderedDict
 from operator import add, mul
@@ -15,10 +16,21 @@ from peri import util
 from peri.comp import Component
 from peri.interpolation import BarnesInterpolation1D,BarnesInterpolationND
 
+def _slice_broadcast(arr, slicer):
+    """Slice `arr` with `slicer` along the axes which are not broadcast"""
+    return arr[tuple(s if n > 1 else np.s_[:] for s, n in zip(slicer, arr.shape))]
+
 #=============================================================================
 # Pure 3d functional representations of ILMs
 #=============================================================================
 class Polynomial3D(Component):
+    # with `lazy_field`, the field is not kept at its full shape. Each tile
+    # requested by `get` is evaluated from the coefficients instead, and the
+    # most recent ones are cached up to `tile_cache_size` bytes. Set it
+    # before the component is initialized.
+    lazy_field = False
+    tile_cache_size = 2**27
+
     def __init__(self, order=(1,1,1), tileinfo=None, constval=None,
             category='ilm', shape=None, float_precision=np.float64):
         """
@@ -80,7 +92,9 @@ class Polynomial3D(Component):
     def initialize(self):
         self.r = self.rvecs()
         self.set_tile(self.shape)
-        self.field = np.zeros(self.shape.shape, dtype=self.float_precision)
+        self._tiles = util.TileCache(self.tile_cache_size)
+        if not self.lazy_field:
+            self.field = np.zeros(self.shape.shape, dtype=self.float_precision)
         self.update(self.params, self.values)
 
     def rvecs(self):
@@ -94,9 +108,10 @@ class Polynomial3D(Component):
             vecs = self.shape.coords(norm=self.shape.shape)
         return vecs
 
-    def term_ijk(self, index):
+    def term_ijk(self, index, r=None):
+        r = self.r if r is None else r
         i,j,k = index
-        return self.r[0]**i * self.r[1]**j * self.r[2]**k
+        return r[0]**i * r[1]**j * r[2]**k
 
     def term(self, index):
         if self.__dict__.get('_last_index') and index == self._last_index:
@@ -110,11 +125,23 @@ class Polynomial3D(Component):
     def set_tile(self, tile):
         self.tile = tile
 
+    def calc_tile(self, tile):
+        """The field over the region `tile` from the coefficients"""
+        r = [_slice_broadcast(v, tile.slicer) for v in self.r]
+        field = np.zeros(tile.shape, dtype=self.float_precision)
+        for p,v in zip(self.params, self.values):
+            if v != 0:
+                field += v * self.term_ijk(self.param_term[p], r=r)
+        return field
+
     def update(self, params, values):
         params = util.listify(params)
         values = util.listify(values)
 
-        if len(params) < len(self.params)//2:
+        if self.lazy_field:
+            self.set_values(params, values)
+            self._tiles.clear()
+        elif len(params) < len(self.params)//2:
             for p,v1 in zip(params, values):
                 v0 = self.get_values(p)
                 tm = self.param_term[p]
@@ -129,8 +156,20 @@ class Polynomial3D(Component):
                 self.field += v * self.term(self.param_term[p])
 
     def get(self):
+        if self.lazy_field:
+            return self._tiles.get(self.tile, self.calc_tile)
         return self.field[self.tile.slicer]
 
+    def get_field_gradient(self, param):
+        """
+        The field is linear in its coefficients, so the derivative wrt a
+        coefficient `param` is its basis term over the whole field
+        """
+        if param not in self.param_term:
+            return None
+        term = self.term_ijk(self.param_term[param])
+        return self.shape.copy(), np.broadcast_to(term, self.shape.shape)
+
     def get_params(self):
         return self.params
 
@@ -139,7 +178,7 @@ class Polynomial3D(Component):
 
     def nopickle(self):
         return super(Polynomial3D, self).nopickle() + [
-            'r', 'field', '_last_term', '_last_index'
+            'r', 'field', '_last_term', '_last_index', '_tiles'
         ]
 
     def __str__(self):
@@ -173,18 +212,22 @@ class LegendrePoly3D(Polynomial3D):
         vecs = [2*v - 1 for v in vecs]
         return vecs
 
-    def term_ijk(self, index):
+    def term_ijk(self, index, r=None):
+        r = self.r if r is None else r
         i,j,k = index
         ci = np.zeros(i+1)
         cj = np.zeros(j+1)
         ck = np.zeros(k+1)
         ci[-1] = cj[-1] = ck[-1] = 1
-        return legval(self.r[0], ci) * legval(self.r[1], cj) * legval(self.r[2], ck)
+        return legval(r[0], ci) * legval(r[1], cj) * legval(r[2], ck)
 
 #=============================================================================
 # 2+1d functional representations of ILMs, p(x,y)+q(z)
 #=============================================================================
 class Polynomial2P1D(Polynomial3D):
+    # the field is always kept in its factored form, see `field`
+    lazy_field = True
+
     def __init__(self, order=(1,1,1), tileinfo=None, constval=None,
             operation='*', category='ilm', shape=None,
             float_precision=np.float64):
@@ -263,9 +306,30 @@ class Polynomial2P1D(Polynomial3D):
 
     def initialize(self):
         self.r = self.rvecs()
-        self.field_xy = 0*self.term_ijk((0,0))
-        self.field_z = 0*self.term_ijk((0,))
-        super(Polynomial2P1D, self).initialize()
+        self._terms_1d = {}
+        self._tiles = util.TileCache(self.tile_cache_size)
+        self.set_tile(self.shape)
+        self.calc_field()
+
+    @property
+    def field(self):
+        """
+        The field over the whole shape. It is only stored in its factored
+        form `field_xy` and `field_z`, and joined for the tile in `get`.
+        """
+        return self._join(self.field_xy, self.field_z)
+
+    def _join(self, field_xy, field_z):
+        op = {'*': mul, '+': add}[self.operation]
+        return op(field_xy, 1.0 + field_z).astype(self.float_precision)
+
+    def calc_tile(self, tile):
+        """The field over the region `tile` from its factors"""
+        slicer = tile.slicer
+        return self._join(
+            _slice_broadcast(self.field_xy, slicer),
+            _slice_broadcast(self.field_z, slicer)
+        )
 
     def calc_field(self):
         self.field_xy = 0*self.term_ijk((0,0))
@@ -281,18 +345,25 @@ class Polynomial2P1D(Polynomial3D):
 
             term += v * self.term(order)
 
-        op = {'*': mul, '+': add}[self.operation]
-        self.field[:] = op(self.field_xy, 1.0 + self.field_z)
-        return self.field
+    def term_1d(self, axis, order):
+        """The polynomial of a single `order` along `axis` of the field"""
+        return self.r[axis]**order
+
+    def _term_1d(self, axis, order):
+        # the 1d terms are cached, the xy terms are their products
+        key = (axis, order)
+        if key not in self._terms_1d:
+            self._terms_1d[key] = self.term_1d(axis, order)
+        return self._terms_1d[key]
 
     def term_ijk(self, index):
         if len(index) == 2:
             i,j = index
-            return self.r[2]**i * self.r[1]**j
+            return self._term_1d(2, i) * self._term_1d(1, j)
 
         elif len(index) == 1:
             k = index[0]
-            return self.r[0]**k
+            return self._term_1d(0, k)
 
     def update(self, params, values):
         params = util.listify(params)
@@ -311,17 +382,32 @@ class Polynomial2P1D(Polynomial3D):
                 term -= v0 * self.term(order)
                 self.set_values(p,v1)
                 term += v1 * self.term(order)
-
-            op = {'*': mul, '+': add}[self.operation]
-            self.field[:] = op(self.field_xy, 1.0 + self.field_z)
         else:
             self.set_values(params, values)
-            self.field[:] = self.calc_field()
+            self.calc_field()
+        self._tiles.clear()
+
+    def get_field_gradient(self, param):
+        """
+        The field is linear in each coefficient `param`, so its derivative is
+        the basis term of the coefficient joined with the other polynomial
+        """
+        if param in self.xy_param:
+            term = self.term_ijk(self.xy_param[param])
+            other = 1.0 + self.field_z
+        elif param in self.z_param:
+            term = self.term_ijk(self.z_param[param])
+            other = self.field_xy
+        else:
+            return None
+
+        dfield = term * other if self.operation == '*' else term
+        return self.shape.copy(), np.broadcast_to(dfield, self.shape.shape)
 
     def nopickle(self):
         return super(Polynomial2P1D, self).nopickle() + [
             'r', 'field', 'field_xy', 'field_z',
-            '_last_term', '_last_index'
+            '_last_term', '_last_index', '_terms_1d'
         ]
 
 class LegendrePoly2P1D(Polynomial2P1D):
@@ -333,33 +419,17 @@ class LegendrePoly2P1D(Polynomial2P1D):
         vecs = [2*v - 1 for v in vecs]
         return vecs
 
-    def term_ijk(self, index):
-        if len(index) == 2:
-            i,j = index
-            ci = np.diag(np.ones(i+1))[i]
-            cj = np.diag(np.ones(j+1))[j]
-            return legval(self.r[2], ci) * legval(self.r[1], cj)
-
-        elif len(index) == 1:
-            k = index[0]
-            ck = np.diag(np.ones(k+1))[k]
-            return legval(self.r[0], ck)
+    def term_1d(self, axis, order):
+        c = np.diag(np.ones(order+1))[order]
+        return legval(self.r[axis], c)
 
 class ChebyshevPoly2P1D(Polynomial2P1D):
     def __init__(self, order=(1,1,1), **kwargs):
         super(ChebyshevPoly2P1D, self).__init__(order=order, **kwargs)
 
-    def term_ijk(self, index):
-        if len(index) == 2:
-            i,j = index
-            ci = np.diag(np.ones(i+1))[i]
-            cj = np.diag(np.ones(j+1))[j]
-            return chebval(self.r[2], ci) * chebval(self.r[1], cj)
-
-        elif len(index) == 1:
-            k = index[0]
-            ck = np.diag(np.ones(k+1))[k]
-            return chebval(self.r[0], ck)
+    def term_1d(self, axis, order):
+        c = np.diag(np.ones(order+1))[order]
+        return chebval(self.r[axis], c)
 
 #=============================================================================
 # a complex hidden variable representation of the ILM
@@ -368,6 +438,14 @@ class ChebyshevPoly2P1D(Polynomial2P1D):
 class BarnesPoly(Component, util.CompatibilityPatch):
     category = 'ilm'
 
+    # the largest change of the barnes per unit change of a coefficient which
+    # is left outside of its update tile (and its field gradient)
+    update_tolerance = 1e-12
+
+    # see Polynomial3D
+    lazy_field = False
+    tile_cache_size = 2**27
+
     def __init__(self, npts=(40,20), zorder=7, op='*', barnes_dist=1.75,
             barnes_clip_size=3, local_updates=True, category='ilm', shape=None,
             float_precision=np.float64, donorm=True):
@@ -451,11 +529,50 @@ class BarnesPoly(Component, util.CompatibilityPatch):
     def _barnes_val(self):
         raise NotImplementedError('Implement in subclass')
 
-    def _barnes_full(self):
+    def _calc_barnes_basis(self):
         raise NotImplementedError('Implement in subclass')
 
+    def barnes_basis(self):
+        """
+        The barnes part of the field is linear in the barnes coefficients, so
+        that over the raveled (y, x) plane it is ``barnes_basis().dot(c)``
+        with `c` the values of `param_barnes_pts`. The matrix is sparse when
+        the barnes weights are clipped.
+        """
+        if self._basis is None:
+            self._basis = self._calc_barnes_basis()
+        return self._basis
+
+    def _barnes_full(self):
+        """Returns the shaped values of the barnes on the (x,y)"""
+        coeffs = np.array(self.get_values(self.param_barnes_pts()))
+        b = self.barnes_basis().dot(coeffs)
+        return np.reshape(b, self.shape.shape[1:])[None, :, :]
+
     def get_update_tile(self, params, values):
-        raise NotImplementedError('Implement in subclass')
+        if not self.local_updates:
+            return self.shape.copy()
+
+        params = util.listify(params)
+
+        c = self.category
+        # check for global update requiring parameters:
+        for p in params:
+            if p in self.poly_params or p == c+'-scale' or p == c+'-off':
+                return self.shape.copy()
+
+        # now look for the local update sizes, which do not depend on the
+        # size of the change so that they are also the regions of the field
+        # gradients
+        barnes_params = self.param_barnes_pts()
+        tiles = [
+            self._barnes_support(p)[1] for p in params if p in barnes_params
+        ]
+        tiles = [t for t in tiles if t is not None]
+
+        if len(tiles) == 0:
+            return None
+        return util.Tile.boundingtile(tiles)
 
     def randomize_parameters(self, params, values):
         raise NotImplementedError('Implement in subclass')
@@ -489,9 +606,24 @@ class BarnesPoly(Component, util.CompatibilityPatch):
 
     def calc_field(self):
         op = {'*': mul, '+': add}[self.op]
-        return self.scale * op(1.0 + self._barnes_full(), 1.0 + self.poly).astype(
+        return self.scale * op(1.0 + self.plane, 1.0 + self.poly).astype(
                 self.float_precision) + self.off
 
+    def calc_tile(self, tile):
+        """The field over the region `tile` from the barnes and z-poly"""
+        op = {'*': mul, '+': add}[self.op]
+        plane = _slice_broadcast(self.plane, tile.slicer)
+        poly = _slice_broadcast(self.poly, tile.slicer)
+        return self.scale * op(1.0 + plane, 1.0 + poly).astype(
+                self.float_precision) + self.off
+
+    def _calc_fields(self):
+        # the barnes is only kept on the (y, x) plane
+        self.plane = self._barnes_full()
+        self._tiles.clear()
+        if not self.lazy_field:
+            self.field = self.calc_field()
+
     def calc_poly(self):
         return np.sum([
             self.get_values(p) * self._term(i)
@@ -500,10 +632,12 @@ class BarnesPoly(Component, util.CompatibilityPatch):
 
     def initialize(self):
         self._setup_rvecs()
+        self._basis = None
+        self._tiles = util.TileCache(self.tile_cache_size)
         self.set_tile(self.shape)
 
         self.poly = self.calc_poly()
-        self.field = self.calc_field()
+        self._calc_fields()
 
         if self._norm_stat:
             ptp, vmin = self._norm_stat
@@ -535,19 +669,75 @@ class BarnesPoly(Component, util.CompatibilityPatch):
                     self.poly += (v1-v0) * tm
 
             self.set_values(params, values)
-            self.field = self.calc_field()
         else:
             self.set_values(params, values)
             self.poly = self.calc_poly()
-            self.field = self.calc_field()
+        self._calc_fields()
 
     def get(self):
+        if self.lazy_field:
+            return self._tiles.get(self.tile, self.calc_tile)
         return self.field[self.tile.slicer]
 
+    def get_field_gradient(self, param):
+        """
+        The field is linear in each of its parameters. The derivative wrt a
+        barnes coefficient is its column of `barnes_basis` joined with the
+        z-polynomial, over the part of the plane which that column touches.
+        """
+        c = self.category
+        mult = self.op == '*'
+        if param == c+'-off':
+            return self.shape.copy(), np.broadcast_to(1.0, self.shape.shape)
+
+        if param == c+'-scale':
+            op = {'*': mul, '+': add}[self.op]
+            dfield = op(1.0 + self.plane, 1.0 + self.poly)
+            return self.shape.copy(), np.broadcast_to(dfield, self.shape.shape)
+
+        if param in self.poly_params:
+            term = self._term(self.poly_params[param])
+            dfield = term * (1.0 + self.plane) if mult else term
+            return self.shape.copy(), np.broadcast_to(
+                    self.scale * dfield, self.shape.shape)
+
+        if param not in self.param_barnes_pts():
+            return None
+
+        col, tile = self._barnes_support(param)
+        if tile is None:
+            return self.shape.copy(), np.broadcast_to(0.0, self.shape.shape)
+
+        db = self.scale * col[tile.translate(-self.shape.l).slicer[1:]][None]
+        dfield = db * (1.0 + self.poly) if mult else db
+        return tile, np.broadcast_to(dfield, tile.shape)
+
+    def _barnes_support(self, param):
+        """
+        The column of `barnes_basis` for the coefficient `param` on the (y, x)
+        plane, and the tile outside of which it is below `update_tolerance`
+        (None if it is nowhere above it)
+        """
+        col = self.barnes_basis()[:, self.param_barnes_pts().index(param)]
+        col = col.toarray() if sparse.issparse(col) else col
+        col = np.reshape(col, self.shape.shape[1:])
+
+        big = np.abs(col) > self.update_tolerance
+        nz = [np.flatnonzero(np.any(big, axis=1-i)) for i in range(2)]
+        if len(nz[0]) == 0:
+            return col, None
+
+        (y0, y1), (x0, x1) = [(i.min(), i.max()+1) for i in nz]
+        tile = util.Tile(
+            self.shape.l + np.array([0, y0, x0]),
+            self.shape.l + np.array([self.shape.shape[0], y1, x1])
+        )
+        return col, tile
+
     def nopickle(self):
         return super(BarnesPoly, self).nopickle() + [
-            'poly', 'b_in', 'b_out', 'r', 'field',
-            '_last_term', '_last_index'
+            'poly', 'b_in', 'b_out', 'r', 'field', 'plane', '_tiles',
+            '_last_term', '_last_index', '_barnes_operators', '_basis'
         ]
 
     def __str__(self):
@@ -647,72 +837,50 @@ class BarnesStreakLegPoly2P1D(BarnesPoly):
             np.linspace(self.b_out.min(), self.b_out.max(), q)
             for q in self.npts
         ]
+        self._barnes_operators = {}
 
-    def _barnes(self, y, n=0):
+    def _barnes_interpolator(self, n=0):
         b_in = self.b_in[n]
         fdst = (b_in[1] - b_in[0])*1.0/self.barnes_dist
         coeffs = self.get_values(self.barnes_params[n])
 
-        b = BarnesInterpolation1D(
+        return BarnesInterpolation1D(
             b_in, coeffs, filter_size=fdst, damp=0.9, iterations=3,
             clip=self.local_updates, clipsize=self.barnes_clip_size,
             donorm=self.donorm
         )
-        return b(y)
-
-    def _barnes_val(self, n=0):
-        return self._barnes(self.b_out, n=n)[None,:]
-
-    def _barnes_full(self):
-        barnes = np.array([
-            self._barnes_val(i)*self._barnes_poly(i)
-            for i in range(len(self.npts))
-        ])
-        return barnes.sum(axis=0)[None,:,:]
 
-    def get_update_tile(self, params, values):
-        if not self.local_updates:
-            return self.shape.copy()
-
-        params = util.listify(params)
-        values = util.listify(values)
-
-        c = self.category
-        # check for global update requiring parameters:
-        for p in params:
-            if p in self.poly_params or p == c+'-scale' or p == c+'-off':
-                return self.shape.copy()
-
-        # now look for the local update sizes
-        orig_values = self.get_values(params)
-
-        tiles = []
-        for p,v in zip(params, values):
-            # figure out the barnes local update size
-            for n, grp in enumerate(self.barnes_params):
-                if not p in grp:
-                    continue
-
-                val0 = self._barnes(self.b_out, n=n)
-                self.set_values(p, v)
-                val1 = self._barnes(self.b_out, n=n)
-
-                inds = np.arange(self.b_out.shape[0])
-                inds = inds[np.abs(val1 - val0) > 1e-12]
-                if len(inds) < 2:
-                    continue
+    def _barnes_operator(self, n=0):
+        """
+        The Barnes interpolation of streak `n` onto `b_out` as a matrix
+        acting on its control point values. It only depends on the geometry,
+        so it is built once and stored sparse when the weights are clipped.
+        """
+        if n not in self._barnes_operators:
+            op = self._barnes_interpolator(n).operator(self.b_out)
+            if self.local_updates:
+                op = sparse.csc_matrix(op)
+            self._barnes_operators[n] = op
+        return self._barnes_operators[n]
 
-                l, r = inds.min(), inds.max()
+    def _barnes(self, y, n=0):
+        if y is self.b_out:
+            coeffs = np.array(self.get_values(self.barnes_params[n]))
+            return self._barnes_operator(n).dot(coeffs)
+        return self._barnes_interpolator(n)(y)
 
-                tile = self.shape.copy()
-                tile.l[2] = l
-                tile.r[2] = r
-                tiles.append(util.Tile(tile.l, tile.r))
+    def _barnes_val(self, n=0):
+        return self._barnes(self.b_out, n=n)[None,:]
 
-        self.set_values(params, orig_values)
-        if len(tiles) == 0:
-            return None
-        return util.Tile.boundingtile(tiles)
+    def _calc_barnes_basis(self):
+        """Each streak's operator in x times its Legendre polynomial in y"""
+        ops = [
+            (self._barnes_poly(n), self._barnes_operator(n))
+            for n in range(len(self.npts))
+        ]
+        if self.local_updates:
+            return sparse.hstack([sparse.kron(p, o) for p, o in ops], format='csc')
+        return np.hstack([np.kron(p, o) for p, o in ops])
 
     def randomize_parameters(self, ptp=0.2, fourier=False, vmin=None, vmax=None):
         """
@@ -765,6 +933,10 @@ class BarnesStreakLegPoly2P1D(BarnesPoly):
             self.initialize()
 
 class BarnesXYLegPolyZ(BarnesPoly):
+    # the 2D kernels have long tails after the iterations, so that the exact
+    # support of a coefficient is most of the image
+    update_tolerance = 1e-5
+
     def __init__(self, npts=(40,20), zorder=7, op='*', barnes_dist=1.75,
             barnes_clip_size=3, category='ilm', shape=None,
             float_precision=np.float64):
@@ -819,26 +991,36 @@ class BarnesXYLegPolyZ(BarnesPoly):
                 barnes_values.append(0.0)
         return barnes_params, barnes_params, barnes_values
 
+    def param_barnes_pts(self, ind=None):
+        # the barnes params are a flat list, not one list per streak
+        if ind is None:
+            return list(self.barnes_params)
+        return [self.barnes_params[ind]]
 
-    def _barnes(self, pos):
-        """Creates a barnes interpolant & calculates its values"""
-        b_in = self.b_in
-        dist = lambda x: np.sqrt(np.dot(x,x))
+    def _barnes_interpolator(self):
         #we take a filter size as the max distance between the grids along
         #x or y:
-        sz = self.npts[1]
         coeffs = self.get_values(self.barnes_params)
-
-        b = BarnesInterpolationND(
-            b_in, coeffs, filter_size=self.filtsize, damp=0.9, iterations=3,
-            clip=self.local_updates, clipsize=self.barnes_clip_size,
+        return BarnesInterpolationND(
+            self.b_in, coeffs, filter_size=self.filtsize, damp=0.9,
+            iterations=3, clip=self.local_updates,
+            clipsize=self.barnes_clip_size,
             blocksize=100  # FIXME magic blocksize
         )
-        return b(pos)  # (N,) shape
+
+    def _barnes(self, pos):
+        """Creates a barnes interpolant & calculates its values"""
+        return self._barnes_interpolator()(pos)  # (N,) shape
 
     def _barnes_val(self):
         """Returns the raveled values of the barnes on the field"""
-        return self._barnes(self.b_out)
+        coeffs = np.array(self.get_values(self.barnes_params))
+        return self.barnes_basis().dot(coeffs)
+
+    def _calc_barnes_basis(self):
+        # the operator onto the whole plane, built a few rows at a time
+        op = self._barnes_interpolator().operator(self.b_out, blocksize=4096)
+        return op.tocsc()
 
     def _setup_rvecs(self):
         o = self.shape.shape
@@ -854,54 +1036,6 @@ class BarnesXYLegPolyZ(BarnesPoly):
         dxs = [b[1] - b[0] for b in _b_in]
         self.filtsize = np.sqrt(np.dot(dxs, dxs))
 
-    def _barnes_full(self):
-        """Returns the shaped values of the barnes on the (x,y)"""
-        return np.reshape(self._barnes_val(), self.shape.shape[1:])[None, :, :]
-
-    def get_update_tile(self, params, values):
-        #a lot of this is duplicated from parent to here
-        if not self.local_updates:
-            return self.shape.copy()
-
-        params = util.listify(params)
-        values = util.listify(values)
-
-        c = self.category
-        # check for global update requiring parameters:
-        for p in params:
-            if p in self.poly_params or p == c+'-scale' or p == c+'-off':
-                return self.shape.copy()
-
-        # now look for the local update sizes
-        orig_values = self.get_values(params)  #see for loop...
-        tiles = []
-        for p,v in zip(params, values):
-            # figure out the barnes local update size
-            # looks like matt does this by changing each param, then seeing
-            # manually which points have changed....
-            if not p in self.barnes_params:
-                raise RuntimeError('Im confused...')
-            val0 = self._barnes(self.b_out)
-            self.set_values(p, v)
-            val1 = self._barnes(self.b_out)
-
-            inds = np.arange(self.b_out.shape[0])
-            inds = inds[np.abs(val1 - val0) > 1e-12]
-            if len(inds) < 2:
-                continue
-
-            l, r = inds.min(), inds.max()
-
-            tile = self.shape.copy()
-            tile.l[2] = l
-            tile.r[2] = r
-            tiles.append(util.Tile(tile.l, tile.r))
-
-            # raise NotImplementedError('Local updates not implemented yet')
-        if len(tiles) == 0:
-            return None
-        return util.Tile.boundingtile(tiles)
-
     def randomize_parameters(self, **kwargs):
         raise NotImplementedError
 
@@ -3,15 +3,7 @@ from builtins import range, str
 import numpy as np
 from scipy.special import erf
 
-try:
-    from scipy.weave import inline
-except ImportError as e:
-    try:
-        from weave import inline
-    except ImportError as e:
-        pass
-
-from peri.special import functions
+from peri.special import jit, erf_poly
 from peri.comp import Component
 from peri.util import Tile, cdd, listify, delistify
 
@@ -353,40 +345,30 @@ def sphere_analytical_gaussian_trim(dr, a, alpha=0.2765, cut=1.6):
     ans[dr < -cut] = 1
     return ans
 
-def sphere_analytical_gaussian_fast(dr, a, alpha=0.2765, cut=1.20):
-    """
-    See sphere_analytical_gaussian_trim, but implemented in C with
-    fast erf and exp approximations found at
-        Abramowitz and Stegun: Handbook of Mathematical Functions
-        A Fast, Compact Approximation of the Exponential Function
+@jit
+def _sphere_fast_band(dr, a, alpha):
+    """ The profile of sphere_analytical_gaussian_fast within the cut """
+    t = -dr/(alpha*np.sqrt(2))
+    at = np.abs(t)
+    e = np.exp(-at*at)
+    erf = np.sign(t)*(1 - erf_poly(at)*e)
+    return 0.5*(1 + erf) - np.sqrt(0.5/np.pi)*(alpha/(dr+a+1e-10)) * e
 
-    The default cut 1.25 was chosen based on the accuracy of fast_erf
+def sphere_analytical_gaussian_fast(dr, a, alpha=0.2765, cut=1.20):
     """
+    See sphere_analytical_gaussian_trim, but with a fast erf approximation
+    found in Abramowitz and Stegun: Handbook of Mathematical Functions, and
+    sharing the exponential between the two terms. The kernel is compiled
+    with numba if it is installed.
 
-    code = """
-    double coeff1 = 1.0/(alpha*sqrt(2.0));
-    double coeff2 = sqrt(0.5/pi)*alpha;
-
-    for (int i=0; i<N; i++){
-        double dri = dr[i];
-        if (dri < cut && dri > -cut){
-            double t = -dri*coeff1;
-            ans[i] = 0.5*(1+fast_erf(t)) - coeff2/(dri+a+1e-10) * fast_exp(-t*t);
-        } else {
-            ans[i] = 0.0*(dri > cut) + 1.0*(dri < -cut);
-        }
-    }
+    The default cut 1.20 was chosen based on the accuracy of fast_erf
     """
+    dr = np.asarray(dr, dtype='float')
+    ans = np.array(dr <= -cut, dtype='float')
 
-    shape = r.shape
-    r = r.flatten()
-    N = self.N
-    ans = r*0
-    pi = np.pi
-
-    inline(code, arg_names=['dr', 'a', 'alpha', 'cut', 'ans', 'pi', 'N'],
-            support_code=functions, verbose=0)
-    return ans.reshape(shape)
+    m = np.abs(dr) < cut
+    ans[m] = _sphere_fast_band(dr[m], a, alpha)
+    return ans
 
 def sphere_constrained_cubic(dr, a, alpha):
     """
@@ -401,19 +383,16 @@ def sphere_constrained_cubic(dr, a, alpha):
     a, d = rscl + 0.5*sqrt3, rscl - 0.5*sqrt3
     return alpha*d*a*rscl + b_coeff*d*a - d/sqrt3
 
-try:
-    sphere_analytical_gaussian_fast(np.linspace(0,10,10), 5.0)
-except Exception as e:
-    sphere_analytical_gaussian_fast = sphere_analytical_gaussian_trim
-
 def exact_volume_sphere(rvec, pos, radius, zscale=1.0, volume_error=1e-5,
-        function=sphere_analytical_gaussian, max_radius_change=1e-2, args=()):
+        function=sphere_analytical_gaussian, max_radius_change=1e-2, args=(),
+        return_radius=False):
     """
     Perform an iterative method to calculate the effective sphere that perfectly
-    (up to the volume_error) conserves volume.  Return the resulting image
+    (up to the volume_error) conserves volume.  Return the resulting image, and
+    if `return_radius` the effective radius with which it was drawn.
     """
     vol_goal = 4./3*np.pi*radius**3 / zscale
-    rprime = radius
+    rprime = rdrawn = radius
 
     dr = inner(rvec, pos, rprime, zscale=zscale)
     t = function(dr, rprime, *args)
@@ -429,9 +408,250 @@ def exact_volume_sphere(rvec, pos, radius, zscale=1.0, volume_error=1e-5,
 
         dr = inner(rvec, pos, rprime, zscale=zscale)
         t = function(dr, rprime, *args)
+        rdrawn = rprime
 
+    if return_radius:
+        return t, rdrawn
     return t
 
+class ExactVolumeTable(object):
+    def __init__(self, function=sphere_analytical_gaussian, args=(),
+            zscale=1.0, support_pad=4, volume_error=1e-5,
+            max_radius_change=1e-2, dr_step=5e-3, rad_step=2.5e-2):
+        """
+        Lookup table of the volume corrected sphere profile as a function of
+        the signed distance to the edge and the radius, which replaces the
+        iterations of :func:`exact_volume_sphere` by a single interpolation
+        over the drawing tile.
+
+        The table is made of rows on a fixed grid of radii, each calculated
+        the first time it is needed and never changed afterwards, so that a
+        particle drawn with the table is undrawn exactly. For every row, the
+        radius that conserves the volume is found with
+        :func:`exact_volume_sphere`, averaged over several subpixel positions,
+        and the profile is tabulated with that radius.
+
+        Since the volume of the iterative version also depends on the
+        subpixel position of the particle, which is averaged out here, the
+        two agree to about a hundredth of a pixel in effective radius. Near
+        the image edges, where the iterations are cut short, they can differ
+        by more.
+
+        Parameters
+        ----------
+        function : callable
+            The sphere function, with call signature `func(dr, a, *args)`
+
+        args : tuple
+            Extra arguments to the sphere function
+
+        zscale : float
+            Scaling of z-pixels in the platonic image
+
+        support_pad : int
+            Padding of the particle drawing tiles
+
+        volume_error : float
+            Relative volume error tolerance of the iterations for each row
+
+        max_radius_change : float
+            Maximum relative radius change of the iterations for each row
+
+        dr_step : float
+            Spacing of the table in distance to the edge
+
+        rad_step : float
+            Spacing of the table in radius
+        """
+        self.function = function
+        self.args = tuple(args)
+        self.zscale = zscale
+        self.support_pad = support_pad
+        self.volume_error = volume_error
+        self.max_radius_change = max_radius_change
+        self.dr_step = dr_step
+        self.rad_step = rad_step
+        self.rows = {}
+
+    def _offsets(self):
+        """ Subpixel positions over which the volume correction is averaged """
+        return np.array(np.meshgrid(*[[0.25, 0.75]]*3)).reshape(3, -1).T
+
+    def _row(self, k):
+        """
+        Corrected radius, first distance index and profile of the radius
+        k*rad_step, the distances being multiples of dr_step
+        """
+        if k in self.rows:
+            return self.rows[k]
+
+        rad = k*self.rad_step
+        zsc = np.array([1.0/self.zscale, 1, 1])
+        r = np.round(zsc*np.ceil(rad) + self.support_pad)
+
+        rads = [0.0]
+        if rad > 0:
+            rads = []
+            for offset in self._offsets():
+                pos = r + 1 + offset
+                tile = Tile(np.round(pos)-r, np.round(pos)+r)
+                _, rdrawn = exact_volume_sphere(
+                    tile.coords(form='vector'), pos, rad, zscale=self.zscale,
+                    volume_error=self.volume_error, function=self.function,
+                    max_radius_change=self.max_radius_change, args=self.args,
+                    return_radius=True
+                )
+                rads.append(rdrawn)
+        rprime = np.mean(rads)
+
+        # the distance to the edge is bounded below by the center of the
+        # particle and above by the farthest corner of the drawing tile
+        stretch = 1.0/min(self.zscale, 1.0)
+        dlo = -rprime*stretch - 1
+        dhi = np.sqrt(3)*(np.ceil(rad+self.rad_step)*stretch + self.support_pad + 1)
+        j0, j1 = int(np.floor(dlo/self.dr_step)), int(np.ceil(dhi/self.dr_step))
+        dr = self.dr_step*np.arange(j0, j1+1)
+
+        self.rows[k] = (rprime, j0, self.function(dr, rprime, *self.args))
+        return self.rows[k]
+
+    def radius(self, rad):
+        """ The volume corrected radius of a particle with radius `rad` """
+        k = int(np.floor(rad / self.rad_step))
+        w = rad / self.rad_step - k
+        return (1-w)*self._row(k)[0] + w*self._row(k+1)[0]
+
+    def __call__(self, rvec, pos, rad):
+        """
+        Draw the sphere at `pos` with radius `rad` over the coordinates `rvec`
+        """
+        k = int(np.floor(rad / self.rad_step))
+        w = rad / self.rad_step - k
+        (r0, j0, f0), (r1, j1, f1) = self._row(k), self._row(k+1)
+
+        # blend the two rows over the distances they have in common
+        jlo = max(j0, j1)
+        jhi = min(j0 + f0.size, j1 + f1.size)
+        profile = (1-w)*f0[jlo-j0:jhi-j0] + w*f1[jlo-j1:jhi-j1]
+
+        # the same distance as `inner`, dr = |u| (1 - a / |s u|)
+        u = rvec - pos - 1e-8
+        m = np.sqrt(np.einsum('...i,...i->...', u, u))
+        n = np.sqrt(np.einsum('...i,...i,i->...', u, u, [self.zscale**2, 1, 1]))
+        x = m*(1 - ((1-w)*r0 + w*r1)/n)/self.dr_step - jlo
+
+        x = np.clip(x, 0, profile.size-2)
+        j = x.astype('int')
+        x -= j
+        return (1-x)*profile[j] + x*profile[j+1]
+
+#=============================================================================
+# Analytic derivatives of the platonic sphere
+#=============================================================================
+def inner_gradient(r, p, a, zscale=1.0):
+    """
+    Derivatives of :func:`inner` with respect to the sphere center and radius.
+    Returns ``(dr, grad)`` where ``grad[...,i]`` is d(dr)/d(z,y,x,a)[i].
+    """
+    eps = np.array([1,1,1])*1e-8
+    s = np.array([zscale, 1.0, 1.0])
+
+    # inner can be written as dr = m*(1 - a/n), m = |r-p|, n = |s*(r-p)|
+    u = r-p-eps
+    m = norm(u)[...,None]
+    n = norm(u*s)[...,None]
+
+    grad = np.zeros(u.shape[:-1] + (4,))
+    grad[...,:3] = -(u/m*(1 - a/n) + a*m*s**2*u/n**3)
+    grad[...,3] = -(m/n)[...,0]
+    return (m*(1 - a/n))[...,0], grad
+
+def sphere_analytical_gaussian_grad(dr, a, alpha=0.2765):
+    """
+    Partial derivatives of :func:`sphere_analytical_gaussian` with respect to
+    `dr` and `a`, returned as a tuple.
+    """
+    c = np.sqrt(0.5/np.pi)
+    s = dr + a + 1e-10
+    e1 = np.exp(-0.5*dr**2/alpha**2)
+    e2 = np.exp(-0.5*(dr+2*a)**2/alpha**2)
+
+    ddr = c/alpha*(e2 - e1) - c*alpha*(
+        -(e1 - e2)/s**2 + (-dr*e1 + (dr+2*a)*e2)/(alpha**2*s)
+    )
+    da = 2*c/alpha*e2 - c*alpha*(
+        -(e1 - e2)/s**2 + 2*(dr+2*a)*e2/(alpha**2*s)
+    )
+    return ddr, da
+
+def sphere_analytical_gaussian_trim_grad(dr, a, alpha=0.2765, cut=1.6):
+    """
+    Partial derivatives of :func:`sphere_analytical_gaussian_trim` with respect
+    to `dr` and `a`, returned as a tuple.
+    """
+    m = np.abs(dr) <= cut
+    c = np.sqrt(0.5/np.pi)
+
+    rr = dr[m]
+    s = rr + a + 1e-10
+    e = np.exp(-0.5*rr**2/alpha**2)
+
+    ddr, da = 0*dr, 0*dr
+    ddr[m] = -c/alpha*e + c*alpha*e/s**2 + c*rr*e/(alpha*s)
+    da[m] = c*alpha*e/s**2
+    return ddr, da
+
+def numerical_sphere_grad(function, dl=1e-5):
+    """
+    Build a gradient function like :func:`sphere_analytical_gaussian_grad`
+    for an arbitrary sphere `function` using central differences of the
+    interpolation profile alone (no redrawing of the particle).
+    """
+    def grad(dr, a, *args):
+        ddr = (function(dr+dl, a, *args) - function(dr-dl, a, *args)) / (2*dl)
+        da = (function(dr, a+dl, *args) - function(dr, a-dl, *args)) / (2*dl)
+        return ddr, da
+    return grad
+
+def sphere_gradient(rvec, pos, radius, zscale=1.0, function=sphere_analytical_gaussian,
+        gradient=sphere_analytical_gaussian_grad, exact_volume=True,
+        volume_error=1e-5, max_radius_change=1e-2, args=()):
+    """
+    Analytic derivative of the sphere image drawn at `pos` with `radius`
+    with respect to (z, y, x, a). Returns an array of shape
+    ``rvec.shape[:-1] + (4,)``.
+
+    For exact volume spheres, the effective radius is found exactly as in
+    :func:`exact_volume_sphere` and its change with the parameters is found
+    from the volume constraint, so that the derivatives include how the
+    effective radius moves with the particle.
+    """
+    rprime = radius
+    if exact_volume:
+        _, rprime = exact_volume_sphere(
+            rvec, pos, radius, zscale=zscale, volume_error=volume_error,
+            function=function, max_radius_change=max_radius_change, args=args,
+            return_radius=True
+        )
+
+    dr, dinner = inner_gradient(rvec, pos, rprime, zscale=zscale)
+    ddr, da = gradient(dr, rprime, *args)
+
+    out = ddr[...,None] * dinner
+    out[...,3] += da
+
+    if exact_volume:
+        # the volume constraint sum(t(p, rprime)) = 4/3 pi a^3 / zscale
+        # gives d(rprime)/dp = -sum(dt/dp) / sum(dt/drprime) for the position
+        # and d(rprime)/da = (4 pi a^2 / zscale) / sum(dt/drprime)
+        drad = out[...,3].copy()
+        dvol = drad.sum()
+        if np.abs(dvol) > 0:
+            dpos = out[...,:3].reshape(-1, 3).sum(axis=0)
+            out[...,:3] -= drad[...,None] * dpos / dvol
+            out[...,3] *= 4*np.pi*radius**2 / zscale / dvol
+    return out
+
 #=============================================================================
 # Actual sphere collection (and slab)
 #=============================================================================
@@ -485,9 +705,13 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             to edge (dr) or particles radius (a). `method` must be set to
             'user-defined'.
 
-        exact_volume : boolean
+        exact_volume : boolean or 'table'
             whether to iterate effective particle size until exact volume
-            (within volume_error) is achieved
+            (within volume_error) is achieved. If 'table', the volume
+            corrected profile is interpolated from a
+            :class:`~peri.comp.objs.ExactVolumeTable` instead, which is
+            faster but only conserves the volume on average over subpixel
+            positions.
 
         volume_error : float
             relative volume error tolerance in iteration steps
@@ -520,6 +744,8 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         self.max_radius_change = max_radius_change
         self.user_method = user_method
         self.grouping = grouping
+        self._last_gradient = None
+        self._volume_table = None
 
         self.set_draw_method(method=method, alpha=alpha, user_method=user_method)
 
@@ -601,6 +827,13 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
             'constrained-cubic': 0.84990,
         }
 
+        # analytic derivatives of the sphere functions wrt (dr, a), anything
+        # missing is differenced numerically from the sphere function
+        self.sphere_gradients = {
+            'exact-gaussian': sphere_analytical_gaussian_grad,
+            'exact-gaussian-trim': sphere_analytical_gaussian_trim_grad,
+        }
+
         if user_method:
             self.sphere_functions['user-defined'] = user_method[0]
             self.alpha_defaults['user-defined'] = user_method[1]
@@ -611,6 +844,14 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         else:
             self.alpha = tuple(listify(self.alpha_defaults[self.method]))
 
+    def _draw_tile(self, pos, rad):
+        """ Tile and coordinates over which to draw a particle at `pos` """
+        p = np.round(pos)
+        r = np.round(np.array([1.0/self.zscale,1,1])*np.ceil(rad)+self.support_pad)
+
+        tile = Tile(p-r, p+r, 0, self.shape.shape)
+        return tile, tile.coords(form='vector')
+
     def _draw_particle(self, pos, rad, sign=1):
         # we can't draw 0 radius particles correctly, abort
         if rad == 0.0:
@@ -618,16 +859,13 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
 
         # translate to its actual position in the padded image
         pos = self._trans(pos)
-
-        p = np.round(pos)
-        r = np.round(np.array([1.0/self.zscale,1,1])*np.ceil(rad)+self.support_pad)
-
-        tile = Tile(p-r, p+r, 0, self.shape.shape)
-        rvec = tile.coords(form='vector')
+        tile, rvec = self._draw_tile(pos, rad)
 
         # if required, do an iteration to find the best radius to produce
         # the goal volume as given by the particular goal radius
-        if self.exact_volume:
+        if self.exact_volume == 'table':
+            t = sign*self.get_volume_table()(rvec, pos, rad)
+        elif self.exact_volume:
             t = sign*exact_volume_sphere(
                 rvec, pos, rad, zscale=self.zscale, volume_error=self.volume_error,
                 function=self.sphere_functions[self.method], args=self.alpha,
@@ -640,6 +878,59 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
 
         self.particles[tile.slicer] += t
 
+    def get_volume_table(self):
+        """
+        The :class:`~peri.comp.objs.ExactVolumeTable` for the current drawing
+        method and zscale, made anew when either changes.
+        """
+        key = (self.method, self.alpha, self.zscale, self.support_pad,
+                self.volume_error, self.max_radius_change)
+        if self._volume_table is None or self._volume_table[0] != key:
+            table = ExactVolumeTable(
+                function=self.sphere_functions[self.method], args=self.alpha,
+                zscale=self.zscale, support_pad=self.support_pad,
+                volume_error=self.volume_error,
+                max_radius_change=self.max_radius_change
+            )
+            self._volume_table = (key, table)
+        return self._volume_table[1]
+
+    def get_field_gradient(self, param):
+        """
+        Analytic derivative of the drawn particles with respect to one of the
+        position or radius parameters of a single particle. The four
+        derivatives of a particle are calculated together and the last
+        particle is kept so that its remaining parameters are free.
+        """
+        typ, ind = self._p2i(param)
+        if typ not in ['z', 'y', 'x', 'a'] or self.rad[ind] <= 0:
+            return None
+
+        # the tabulated profile is left to finite differences
+        if self.exact_volume == 'table':
+            return None
+
+        pos, rad = self._trans(self.pos[ind]), self.rad[ind]
+        key = (ind, tuple(pos), rad, self.zscale, self.method, self.alpha)
+
+        if self._last_gradient is None or self._last_gradient[0] != key:
+            function = self.sphere_functions[self.method]
+            gradient = self.sphere_gradients.get(self.method)
+            if gradient is None:
+                gradient = numerical_sphere_grad(function)
+
+            tile, rvec = self._draw_tile(pos, rad)
+            grad = sphere_gradient(
+                rvec, pos, rad, zscale=self.zscale, function=function,
+                gradient=gradient, exact_volume=self.exact_volume,
+                volume_error=self.volume_error, args=self.alpha,
+                max_radius_change=self.max_radius_change
+            )
+            self._last_gradient = (key, tile, grad)
+
+        _, tile, grad = self._last_gradient
+        return tile, grad[..., ['z', 'y', 'x', 'a'].index(typ)]
+
     def param_radii(self):
         """ Return params of all radii """
         return [self._i2p(i, 'a') for i in range(self.N)]
@@ -782,7 +1073,8 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
     def __getstate__(self):
         odict = self.__dict__.copy()
         cdd(odict, super(PlatonicSpheresCollection, self).nopickle())
-        cdd(odict, ['rvecs', 'particles', '_params'])
+        cdd(odict, ['rvecs', 'particles', '_params', '_last_gradient',
+            '_volume_table'])
         return odict
 
     def __setstate__(self, idict):
@@ -790,6 +1082,8 @@ class PlatonicSpheresCollection(PlatonicParticlesCollection):
         ##Compatibility patches...
         self.float_precision = self.__dict__.get('float_precision', np.float64)
         ##end compatibility patch
+        self._last_gradient = None
+        self._volume_table = None
         self.setup_variables()
         if self.shape:
             self.initialize()
@@ -9,6 +9,10 @@ from peri import util
 from peri import interpolation
 from peri.comp import psfs
 
+#Largest ratio of (unique z) * (unique rho) to the number of points for
+#which get_K tabulates the integrals instead of evaluating them pointwise
+K_TABLE_FACTOR = 4
+
 def j2(x):
     """ A fast j2 defined in terms of other special functions """
     to_return = 2./(x+1e-15)*j1(x) - j0(x)
@@ -220,7 +224,9 @@ def get_K(rho, z, alpha=1.0, zint=100.0, n2n1=0.95, get_hdet=False, K=1,
         Kprefactor : numpy.ndarray or None
             This array is calculated internally and optionally returned;
             pass it back to avoid recalculation and increase speed. Default
-            is None, i.e. calculate it internally.
+            is None, i.e. calculate it internally. It is sampled at the
+            unique values of `z`, so it can only be passed back with the
+            same `z`.
         return_Kprefactor : Bool, optional
             Set to True to also return the Kprefactor (parameter above)
             to speed up the calculation for the next values of K. Default
@@ -261,32 +267,40 @@ def get_K(rho, z, alpha=1.0, zint=100.0, n2n1=0.95, get_hdet=False, K=1,
 
     #Getting the array of points to quad at
     cos_theta = 0.5*(1-np.cos(alpha))*pts+0.5*(1+np.cos(alpha))
-    #[cos_theta,rho,z]
+    sin_theta = np.sqrt(1-cos_theta**2)
+
+    #The integrals depend on z only through the prefactor and on rho only
+    #through the Bessel functions, so each is calculated on its unique values
+    zu, zinv = np.unique(zr, return_inverse=True)
+    ru, rinv = np.unique(rr, return_inverse=True)
 
     if Kprefactor is None:
-        Kprefactor = get_Kprefactor(z, cos_theta, zint=zint, \
+        Kprefactor = get_Kprefactor(zu, cos_theta, zint=zint, \
             n2n1=n2n1,get_hdet=get_hdet, **kwargs)
 
     if K==1:
-        part_1 = j0(np.outer(rr,np.sqrt(1-cos_theta**2)))*\
-            np.outer(np.ones_like(rr), 0.5*(get_taus(cos_theta,n2n1=n2n1)+\
-            get_taup(cos_theta,n2n1=n2n1)*csqrt(1-n1n2**2*(1-cos_theta**2))))
-        integrand = Kprefactor * part_1
+        bessel = j0
+        angular = 0.5*(get_taus(cos_theta,n2n1=n2n1)+get_taup(cos_theta,
+            n2n1=n2n1)*csqrt(1-n1n2**2*(1-cos_theta**2)))
     elif K==2:
-        part_2=j2(np.outer(rr,np.sqrt(1-cos_theta**2)))*\
-            np.outer(np.ones_like(rr),0.5*(get_taus(cos_theta,n2n1=n2n1)-\
-            get_taup(cos_theta,n2n1=n2n1)*csqrt(1-n1n2**2*(1-cos_theta**2))))
-        integrand = Kprefactor * part_2
+        bessel = j2
+        angular = 0.5*(get_taus(cos_theta,n2n1=n2n1)-get_taup(cos_theta,
+            n2n1=n2n1)*csqrt(1-n1n2**2*(1-cos_theta**2)))
     elif K==3:
-        part_3=j1(np.outer(rho,np.sqrt(1-cos_theta**2)))*\
-            np.outer(np.ones_like(rr), n1n2*get_taup(cos_theta,n2n1=n2n1)*\
-            np.sqrt(1-cos_theta**2))
-        integrand = Kprefactor * part_3
+        bessel = j1
+        angular = n1n2*get_taup(cos_theta,n2n1=n2n1)*sin_theta
     else:
         raise ValueError('K=1,2,3 only...')
 
-    big_wts=np.outer(np.ones_like(rr), wts)
-    kint = (big_wts*integrand).sum(axis=1) * 0.5*(1-np.cos(alpha))
+    weighted = Kprefactor * (wts*angular*0.5*(1-np.cos(alpha)))
+
+    #For grids, the table of all pairs of unique (z, rho) is one matrix
+    #product and much smaller than the Bessel functions at every point
+    if zu.size*ru.size <= K_TABLE_FACTOR*rr.size:
+        table = np.dot(weighted, bessel(np.outer(ru, sin_theta)).T)
+        kint = table[zinv, rinv]
+    else:
+        kint = (weighted[zinv] * bessel(np.outer(rr, sin_theta))).sum(axis=1)
 
     if return_Kprefactor:
         return kint.reshape(rho.shape), Kprefactor
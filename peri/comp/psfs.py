@@ -50,7 +50,9 @@ class PSF(Component):
         pad = tuple((d[i],d[i]+o[i]) for i in [0,1,2])
         self.rpsf = np.pad(self.min_rpsf, pad, mode='constant', constant_values=0)
         self.rpsf = fft.ifftshift(self.rpsf)
-        self.kpsf = fft.fftn(self.rpsf, **fftkwargs)
+
+        # the psf and fields are real, so only half of the spectrum is kept
+        self.kpsf = fft.rfftn(self.rpsf, **fftkwargs)
         self.kpsf /= (np.real(self.kpsf[0,0,0]) + 1e-15)
         return self.kpsf
 
@@ -82,15 +84,19 @@ class PSF(Component):
             self.set_tile(self.tile)
 
     def execute(self, field):
+        """
+        The real `field` on the current tile convolved with the psf. The
+        psf is applied through half-spectrum transforms, so transformed
+        (complex) fields are not accepted.
+        """
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
+        if np.iscomplexobj(field):
+            raise ValueError("PSF can only be executed on real fields")
 
-        if not np.iscomplex(field.ravel()[0]):
-            infield = fft.fftn(field, **fftkwargs)
-        else:
-            infield = field
+        infield = fft.rfftn(field, **fftkwargs)
 
-        return np.real(fft.ifftn(infield * self.kpsf, **fftkwargs))
+        return fft.irfftn(infield * self.kpsf, s=self.tile.shape, **fftkwargs)
 
     def get(self):
         return self
@@ -227,7 +233,6 @@ class PSF4D(PSF):
     @memoize()
     def _calc_tile_2d_psf(self, tile):
         rpsf = np.zeros(shape=tile.shape)
-        kpsf = np.zeros(shape=tile.shape, dtype='complex')
 
         vecs = self.rvecs(tile)
         zs = self._zpos(tile)
@@ -236,8 +241,9 @@ class PSF4D(PSF):
         for i,z in enumerate(zs):
             rpsf[i] = self.rpsf_xy(vecs, z)
 
-        # calcualte the psf in k-space using 2d ffts
-        kpsf = fft.fft2(rpsf, **fftkwargs)
+        # calcualte the psf in k-space using 2d ffts, keeping only half of
+        # the spectrum since the psf is real
+        kpsf = fft.rfft2(rpsf, **fftkwargs)
 
         # need to normalize each x-y slice individually
         for i,z in enumerate(zs):
@@ -245,6 +251,23 @@ class PSF4D(PSF):
 
         return rpsf, kpsf
 
+    @memoize()
+    def _calc_tile_z_psf(self, tile):
+        """
+        The z part of the psf over the tile as a banded matrix, stored by
+        diagonals so that plane i of the output receives ``bands[w+k, i]``
+        times plane i+k of the input, for ``-w <= k <= w``. Returns w, bands
+        """
+        z = self._zpos(tile)
+        sizes = [self.get_padding_size(tile=None, z=zp).shape[0] for zp in z]
+        w = int(min(np.max(sizes), len(z)-1))
+
+        bands = np.zeros((2*w+1, len(z)))
+        for i in range(len(z)):
+            m = np.nonzero((z >= z[i]-sizes[i]) & (z <= z[i]+sizes[i]))[0]
+            bands[w+m-i, i] = self.rpsf_z(z[m], z[i])
+        return w, bands
+
     def set_tile(self, tile):
         if not hasattr(self, 'tile') or (self.tile != tile).any():
             self.tile = tile
@@ -264,25 +287,24 @@ class PSF4D(PSF):
             self.set_tile(self.tile)
 
     def execute(self, field):
+        """ See `PSF.execute`, for real fields only """
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
+        if np.iscomplexobj(field):
+            raise ValueError("PSF can only be executed on real fields")
 
-        if not np.iscomplexobj(field):
-            infield = fft.fft2(field, **fftkwargs)
-        else:
-            infield = field
+        infield = fft.rfft2(field, **fftkwargs)
 
-        cov2d = np.real(fft.ifft2(infield * self.kpsf, **fftkwargs))
-        cov2dT = np.rollaxis(cov2d, 0, 3)
+        cov2d = fft.irfft2(infield * self.kpsf, s=self.tile.shape[1:], **fftkwargs)
 
+        # convolve in z with the banded matrix, one diagonal at a time
+        w, bands = self._calc_tile_z_psf(self.tile)
         out = np.zeros_like(cov2d)
-        z = self._zpos(self.tile)
+        n = cov2d.shape[0]
 
-        for i in range(len(z)):
-            size = self.get_padding_size(tile=None, z=z[i]).shape
-            m = (z >= z[i]-size[0]) & (z <= z[i]+size[0])
-            g = self.rpsf_z(z[m], z[i])
-            out[i] = cov2dT[...,m].dot(g)
+        for k in range(-w, w+1):
+            lo, hi = max(0, -k), min(n, n-k)
+            out[lo:hi] += bands[w+k, lo:hi, None, None] * cov2d[lo+k:hi+k]
 
         return out
 
@@ -553,27 +575,27 @@ class FromArray(PSF):
         pad = tuple((d[i],d[i]+o[i]) for i in [0,1,2])
         rpsf = np.pad(field, pad, mode='constant', constant_values=0)
         rpsf = fft.ifftshift(rpsf)
-        kpsf = fft.fftn(rpsf, **fftkwargs)
+        kpsf = fft.rfftn(rpsf, **fftkwargs)
         kpsf /= (np.real(kpsf[0,0,0]) + 1e-15)
         return kpsf
 
     def execute(self, field):
+        """ See `PSF.execute`, for real fields only """
         if any(field.shape != self.tile.shape):
             raise AttributeError("Field passed to PSF incorrect shape")
+        if np.iscomplexobj(field):
+            raise ValueError("PSF can only be executed on real fields")
 
-        if not np.iscomplex(field.ravel()[0]):
-            infield = fft.fftn(field, **fftkwargs)
-        else:
-            infield = field
+        infield = fft.rfftn(field, **fftkwargs)
 
-        outfield = np.zeros_like(infield, dtype='float')
+        outfield = np.zeros(self.tile.shape, dtype='float')
 
-        for i in range(field.shape[0]):
+        for i in range(self.tile.shape[0]):
             z = int(self.tile.l[0] + i)
             kpsf = self._pad(self.array[z])
-            outfield[i] = np.real(fft.ifftn(infield * kpsf, **fftkwargs))[i]
+            outfield[i] = fft.irfftn(infield * kpsf, s=self.tile.shape, **fftkwargs)[i]
 
         return outfield
 
-    def get_padding_size(self, tile, z=None):
+    def get_padding_size(self, tile=None, z=None):
         return Tile(self.support)
@@ -16,6 +16,8 @@ Variable name             Default value          Description
 ``log-to-file``           False                  Whether or not to actually save logs to a file as well
 ``log-colors``            False                  Display logs in color (supported by xterm256)
 ``verbosity``             vvv                    Level of verbosity for logs, the more v's the more verbose
+``psf-cache``             ``""``                 Directory of the on-disk cache of exact PSF slices, keyed by
+                                                 the PSF parameters. Empty to disable the cache.
 ========================= ====================== =============================================================
 """
 from future.utils import iteritems
@@ -32,6 +34,7 @@ default_conf = {
     "log-to-file": False,
     "log-colors": False,
     "verbosity": 'vvv',
+    "psf-cache": "",
 }
 
 def get_conf_filename():
@@ -88,3 +91,7 @@ def get_wisdom():
 def get_logfile():
     conf = load_conf()
     return conf['logfile']
+
+def get_psf_cache():
+    conf = load_conf()
+    return conf['psf-cache']
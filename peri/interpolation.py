@@ -1,6 +1,7 @@
 from builtins import range, object
 
 import numpy as np
+from scipy import sparse
 
 
 class BarnesInterpolation1D(object):
@@ -110,21 +111,44 @@ class BarnesInterpolation1D(object):
         else:
             return self._oldcall(rvecs)
 
+    def operator(self, rvecs, blocksize=None):
+        """
+        The interpolation is linear in the data, so that it is the matrix
+        `M` for which ``self(rvecs) == M.dot(self.d)`` for any data `d`.
+        If `blocksize` is given, `M` is found for that many `rvecs` at a
+        time and returned as a scipy.sparse csr matrix, which saves memory
+        when the weights are clipped.
+        """
+        d = self.d
+        try:
+            self.d = np.eye(len(self.x))
+            if not blocksize:
+                return self(rvecs)
+            return sparse.vstack([
+                sparse.csr_matrix(self(rvecs[a:a+blocksize]))
+                for a in range(0, len(rvecs), blocksize)
+            ], format='csr')
+        finally:
+            self.d = d
+
     def _eval_firstorder(self, rvecs, data, sigma):
         """The first-order Barnes approximation"""
+        data = np.asarray(data)
         if not self.blocksize:
             dist_between_points = self._distance_matrix(rvecs, self.x)
             gaussian_weights = self._weight(dist_between_points, sigma=sigma)
-            return gaussian_weights.dot(data) / gaussian_weights.sum(axis=1)
+            norm = gaussian_weights.sum(axis=1)
+            return gaussian_weights.dot(data) / norm.reshape((-1,) + (1,)*(data.ndim-1))
         else:
             # Now rather than calculating the distance matrix all at once,
             # we do it in chunks over rvecs
-            ans = np.zeros(rvecs.shape[0], dtype='float')
+            ans = np.zeros((rvecs.shape[0],) + data.shape[1:], dtype='float')
             bs = self.blocksize
             for a in range(0, rvecs.shape[0], bs):
                 dist = self._distance_matrix(rvecs[a:a+bs], self.x)
                 weights = self._weight(dist, sigma=sigma)
-                ans[a:a+bs] += weights.dot(data) / weights.sum(axis=1)
+                norm = weights.sum(axis=1)
+                ans[a:a+bs] += weights.dot(data) / norm.reshape((-1,) + (1,)*(data.ndim-1))
             return ans
 
     def _newcall(self, rvecs):
@@ -206,7 +230,8 @@ class BarnesInterpolationND(BarnesInterpolation1D):
 
 
 class ChebyshevInterpolation1D(object):
-    def __init__(self, func, args=(), window=(0., 1.), degree=3, evalpts=4):
+    def __init__(self, func, args=(), window=(0., 1.), degree=3, evalpts=4,
+            coefficients=None):
         """A 1D Chebyshev approximation / interpolation for an ND function,
         approximating (N-1)D in in the last dimension.
 
@@ -229,6 +254,10 @@ class ChebyshevInterpolation1D(object):
         evalpts : integer
             Number of Chebyshev points to evaluate the function at
 
+        coefficients : ndarray or None
+            Previously calculated coefficients for this func, window, degree
+            and evalpts, in which case func is not evaluated
+
         Examples
         --------
         >>> import numpy as np
@@ -241,7 +270,13 @@ class ChebyshevInterpolation1D(object):
         self.args = args
         self.func = func
         self.window = window
-        self.set_order(evalpts, degree)
+
+        if coefficients is None:
+            self.set_order(evalpts, degree)
+        else:
+            self.evalpts = evalpts
+            self.degree = degree
+            self._coeffs = coefficients
 
     def _x2c(self, x):
         """ Convert windowdow coordinates to cheb coordinates [-1,1] """
@@ -2,6 +2,9 @@ from future.utils import iteritems
 from builtins import object
 
 import re
+import ast
+import numpy as np
+from collections import OrderedDict
 
 from peri.comp import (
     ComponentCollection, GlobalScalar, ilms, psfs, objs, exactpsf
@@ -41,6 +44,145 @@ allobjs = {
 class ModelError(Exception):
     pass
 
+_Constant = getattr(ast, 'Constant', getattr(ast, 'Num', None))
+
+class Expression(object):
+    # bytes of intermediate arrays kept in the pool between evaluations, the
+    # least recently used shapes are dropped beyond it
+    pool_size = 2**27
+
+    _ufuncs = {
+        ast.Add: np.add, ast.Sub: np.subtract,
+        ast.Mult: np.multiply, ast.Div: np.true_divide,
+    }
+
+    def __init__(self, eq):
+        """
+        A model equation such as ``'H(I*(1-P)+C*P) + B'`` parsed once and
+        evaluated with numpy ufuncs. Rather than allocating a temporary for
+        every operation, each operation writes into an intermediate array that
+        it owns (reused within the evaluation) or into arrays from a pool
+        which is kept between evaluations. Equations using syntax beyond
+        arithmetic, negation and function calls are evaluated with ``eval``.
+
+        Parameters
+        -----------
+        eq : string
+            The equation to evaluate
+        """
+        self.eq = eq
+        self.code = compile(eq, '<model>', 'eval')
+
+        try:
+            self.tree = ast.parse(eq, mode='eval').body
+            self._check(self.tree)
+        except ModelError:
+            self.tree = None
+        self._buffers = OrderedDict()
+        self._size = 0
+
+    def _check(self, node):
+        """ Make sure that only supported syntax is in the tree """
+        if isinstance(node, ast.BinOp) and type(node.op) in self._ufuncs:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            self._check(node.operand)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if getattr(node, 'keywords', None):
+                raise ModelError('Keyword arguments are not supported')
+            for arg in node.args:
+                self._check(arg)
+        elif not isinstance(node, (ast.Name, _Constant)):
+            raise ModelError('Unsupported syntax in %r' % self.eq)
+
+    def _take(self, shape, dtype):
+        """ An array of `shape` from the pool, which we can overwrite """
+        free = self._buffers.get((shape, dtype))
+        if not free:
+            return np.empty(shape, dtype=dtype)
+
+        out = free.pop()
+        self._size -= out.nbytes
+        if not free:
+            del self._buffers[(shape, dtype)]
+        return out
+
+    def _give(self, arr):
+        """ Return an array which is no longer needed to the pool """
+        key = (arr.shape, arr.dtype)
+        self._buffers.setdefault(key, []).append(arr)
+        self._buffers.move_to_end(key)
+        self._size += arr.nbytes
+
+        while self._size > self.pool_size:
+            for old in self._buffers.popitem(last=False)[1]:
+                self._size -= old.nbytes
+
+    def _apply(self, ufunc, args):
+        """
+        Apply `ufunc` to `args`, each a tuple (value, owned), writing into an
+        owned argument if it matches the output or into an array from the pool
+        """
+        values = [a for a, _ in args]
+        if not any([isinstance(v, np.ndarray) for v in values]):
+            return ufunc(*values), False
+
+        shape = np.broadcast(*values).shape
+        dtype = np.result_type(*values)
+
+        out = None
+        for v, owned in args:
+            if owned and v.shape == shape and v.dtype == dtype:
+                out = v
+                break
+        if out is None:
+            out = self._take(shape, dtype)
+
+        ufunc(*values, out=out)
+        for v, owned in args:
+            if owned and v is not out:
+                self._give(v)
+        return out, True
+
+    def _eval(self, node, variables):
+        if isinstance(node, ast.BinOp):
+            args = [self._eval(node.left, variables), self._eval(node.right, variables)]
+            return self._apply(self._ufuncs[type(node.op)], args)
+
+        if isinstance(node, ast.UnaryOp):
+            return self._apply(np.negative, [self._eval(node.operand, variables)])
+
+        if isinstance(node, ast.Call):
+            args = [self._eval(a, variables) for a in node.args]
+            out = variables[node.func.id](*[a for a, _ in args])
+            for v, owned in args:
+                if owned:
+                    self._give(v)
+            return out, False
+
+        if isinstance(node, ast.Name):
+            return variables[node.id], False
+        return getattr(node, 'value', getattr(node, 'n', None)), False
+
+    def evaluate(self, variables):
+        """
+        Evaluate the equation with the symbol to value mapping `variables`
+        """
+        if self.tree is None:
+            return eval(self.code, variables)
+
+        # every intermediate array is given back to the pool once used, only
+        # the result is not and so belongs to the caller
+        out, _ = self._eval(self.tree, variables)
+        return out
+
+    def __getstate__(self):
+        return {'eq': self.eq}
+
+    def __setstate__(self, idct):
+        self.__init__(idct['eq'])
+
 class Model(object):
     def __init__(self, modelstr, varmap, registry={}):
         """
@@ -77,6 +219,7 @@ class Model(object):
         self.registry = registry
         self.ivarmap = {v:k for k, v in iteritems(self.varmap)}
         self.check_consistency()
+        self._expressions = {}
 
     def check_consistency(self):
         """
@@ -206,10 +349,26 @@ class Model(object):
         evar = self.map_vars(comps, funcname, diffmap=diffmap)
 
         if diffmap is None:
-            return eval(self.get_base_model(), evar)
+            eq = self.get_base_model()
         else:
             compname = list(diffmap.keys())[0]
-            return eval(self.get_difference_model(compname), evar)
+            eq = self.get_difference_model(compname)
+        return self.get_expression(eq).evaluate(evar)
+
+    def get_expression(self, eq):
+        """ The :class:`~peri.models.Expression` for equation `eq` """
+        if eq not in self._expressions:
+            self._expressions[eq] = Expression(eq)
+        return self._expressions[eq]
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict.pop('_expressions', None)
+        return odict
+
+    def __setstate__(self, idct):
+        self.__dict__.update(idct)
+        self._expressions = {}
 
     def __str__(self):
         return "{} : {}".format(self.__class__.__name__, self.get_base_model())
@@ -233,6 +392,7 @@ class ConfocalImageModel(Model):
         }
         modelstr = {
             'full' : 'H(I*(1-P)+C*P) + B',
+            'dH' : 'dH(I*(1-P)+C*P)',
             'dI' : 'H(dI*(1-P))',
             'dP' : 'H((C-I)*dP)',
             'dC' : 'H(dC*P)',
@@ -269,7 +429,7 @@ class BlurredFieldModel(Model):
     """
     def __init__(self):
         varmap = {'H': 'psf', 'I': 'ilm'}
-        modelstr = {'full': 'H(I)', 'dI': 'H(dI)'}
+        modelstr = {'full': 'H(I)', 'dH': 'dH(I)', 'dI': 'H(dI)'}
         registry = {'psf': allpsfs, 'ilm': allfields}
         Model.__init__(self, modelstr=modelstr, varmap=varmap, registry=registry)
 
@@ -299,6 +459,7 @@ class ConfocalDyedParticlesModel(Model):
         }
         modelstr = {
             'full': 'H(I*P) + B',
+            'dH': 'dH(I*P)',
             'dP': 'H(I*dP)',
             'dS': 'H(dI*P)',
             'dB': 'dB',
@@ -326,6 +487,7 @@ class BrightfieldImageModel(Model):
         }
         modelstr = {
             'full' :'I*(1+c*H(P)) + B',
+            'dH' : 'I*c*dH(P)',
             'dI' : 'dI*(1+c*H(P))',
             'dP' : 'I*c*H(dP)',
             'dc' : 'I*dc*H(P)',
@@ -7,12 +7,13 @@ import tempfile
 import pickle
 import gc
 
+import multiprocessing
 import numpy as np
 from numpy.random import randint
 from scipy.optimize import newton, minimize_scalar
 
 from peri.util import Tile, Image
-from peri import states
+from peri import states, comp
 from peri import models as mdl
 from peri.logger import log
 CLOG = log.getChild('opt')
@@ -339,6 +340,44 @@ def _check_groups(s, groups):
     else:
         return (np.arange(s.obj_get_radii().size) == np.sort(ans)).all()
 
+def color_particle_groups(s, groups, pad=2):
+    """
+    Colors particle groups so that no two groups of the same color have
+    overlapping update regions, i.e. the groups of one color can be
+    optimized at the same time without affecting each other.
+
+    Parameters
+    ----------
+    s : :class:`peri.states.ImageState`
+        The state with the particles
+    groups : List
+        List of int numpy.ndarrays of particle indices, as returned by
+        separate_particles_into_groups.
+    pad : Int, optional
+        Extra padding of each group's update region, to leave room for
+        the particles to move during the optimization. Default is 2
+
+    Returns
+    -------
+    colors : List
+        Each element is a list of indices into `groups` of one color.
+    """
+    colors, tiles = [], []
+    for i, g in enumerate(groups):
+        params = s.param_particle(g)
+        tile = s.get_update_io_tiles(params, s.get_values(params))[1]
+        tile = tile.pad(pad)
+
+        for color, ctiles in zip(colors, tiles):
+            if not any([((tile & t).shape > 0).all() for t in ctiles]):
+                color.append(i)
+                ctiles.append(tile)
+                break
+        else:
+            colors.append([i])
+            tiles.append([tile])
+    return colors
+
 def calc_particle_group_region_size(s, region_size=40, max_mem=1e9, **kwargs):
     """
     Finds the biggest region size for LM particle optimization with a
@@ -1603,6 +1642,10 @@ class LMGlobals(LMEngine):
             Dict of ``**kwargs`` for opt implementation. Right now only for
             get_num_px_jtj, i.e. keys of 'decimate', 'min_redundant'.
             Default is `{}`. Stored as self.opt_kwargs
+        workers : Int, optional
+            The number of threads over which the columns of J are
+            calculated, each on its own copy of the state. Default is 1.
+            Stored as self.workers
 
     Attributes
     ----------
@@ -1626,10 +1669,12 @@ class LMGlobals(LMEngine):
         do_levmarq : Convenience function for LMGlobals
         do_levmarq_particles : Convenience function for optimizing particles
     """
-    def __init__(self, state, param_names, max_mem=1e9, opt_kwargs={}, **kwargs):
+    def __init__(self, state, param_names, max_mem=1e9, opt_kwargs={},
+            workers=1, **kwargs):
         self.state = state
         self.opt_kwargs = opt_kwargs
         self.max_mem = max_mem
+        self.workers = workers
         self.num_pix = get_num_px_jtj(state, len(param_names), max_mem=max_mem,
                 **self.opt_kwargs)
         self.param_names = param_names
@@ -1645,8 +1690,10 @@ class LMGlobals(LMEngine):
         del self.J
         # self.J, self._inds = get_rand_Japprox(self.state,
                 # self.param_names, num_inds=self.num_pix)
+        # only ImageStates know how to split J among workers
+        kwargs = {'workers': self.workers} if self.workers > 1 else {}
         je, self._inds = get_rand_Japprox(self.state, self.param_names,
-                num_inds=self.num_pix, include_cost=True)
+                num_inds=self.num_pix, include_cost=True, **kwargs)
         self.J = je[0]
         #Storing the _direction_ of the exact gradient of the model, rescaled
         #as to the size we expect from the inds:
@@ -1920,6 +1967,13 @@ class LMParticleGroupCollection(object):
             Set to True to create a series of temp files that save J
             for each group of particles. Needed for do_internal_run().
             Default is False.
+        processes : Int, optional
+            The number of processes over which to optimize the groups.
+            If more than 1, groups are colored with color_particle_groups
+            and the groups of each color are run at the same time in
+            forked processes, whose changes are merged back through
+            shared memory. Requires the `fork` start method (POSIX).
+            Default is 1.
 
     Other Parameters
     ----------------
@@ -1971,13 +2025,14 @@ class LMParticleGroupCollection(object):
     instance will close and remove the temporary files.
     """
     def __init__(self, state, region_size=40, do_calc_size=True, max_mem=1e9,
-            get_cos=False, save_J=False, **kwargs):
+            get_cos=False, save_J=False, processes=1, **kwargs):
         self.state = state
         self._kwargs = kwargs
         self.region_size = region_size
         self.get_cos = get_cos
         self.save_J = save_J
         self.max_mem = max_mem
+        self.processes = processes
 
         self.reset(do_calc_size=do_calc_size)
 
@@ -2034,6 +2089,8 @@ class LMParticleGroupCollection(object):
         j_file, tile_file = self._get_tmpfiles(group_index)
         np.save(j_file, j)
         pickle.dump(tile, tile_file, protocol=2)
+        j_file.flush()
+        tile_file.flush()
 
     def _load_j_diftile(self, group_index):
         j_file, tile_file = self._get_tmpfiles(group_index)
@@ -2042,25 +2099,91 @@ class LMParticleGroupCollection(object):
         JTJ = np.dot(J, J.T)
         return J, JTJ, tile
 
+    def _run_group(self, a, mode='1'):
+        """Optimizes group `a`, returns its termination stats."""
+        group = self.particle_groups[a]
+        lp = LMParticles(self.state, group, **self._kwargs)
+        if mode == 'internal':
+            lp.J, lp.JTJ, lp._dif_tile = self._load_j_diftile(a)
+
+        if mode == '1':
+            lp.do_run_1()
+        if mode == '2':
+            lp.do_run_2()
+        if mode == 'internal':
+            lp.do_internal_run()
+
+        if self.save_J and (mode != 'internal'):
+            self._dump_j_diftile(a, lp.J, lp._dif_tile)
+            self._has_saved_J[a] = True
+        return lp.get_termination_stats(get_cos=self.get_cos)
+
     def _do_run(self, mode='1'):
         """workhorse for the self.do_run_xx methods."""
+        if self.processes > 1:
+            return self._do_run_parallel(mode=mode)
         for a in range(len(self.particle_groups)):
-            group = self.particle_groups[a]
-            lp = LMParticles(self.state, group, **self._kwargs)
-            if mode == 'internal':
-                lp.J, lp.JTJ, lp._dif_tile = self._load_j_diftile(a)
-
-            if mode == '1':
-                lp.do_run_1()
-            if mode == '2':
-                lp.do_run_2()
-            if mode == 'internal':
-                lp.do_internal_run()
-
-            self.stats.append(lp.get_termination_stats(get_cos=self.get_cos))
-            if self.save_J and (mode != 'internal'):
-                self._dump_j_diftile(a, lp.J, lp._dif_tile)
-                self._has_saved_J[a] = True
+            self.stats.append(self._run_group(a, mode=mode))
+
+    def _do_run_parallel(self, mode='1'):
+        """
+        Runs the groups of each color at once in a pool of forked processes.
+        The regions of the groups of one color are disjoint, so the
+        processes update the model and residuals in shared memory directly.
+        The particle changes are then applied to the components here.
+        """
+        global _group_run
+        st = self.state
+        model, residuals = st._model, st._residuals
+        st._model, st._residuals = _shared_array(model), _shared_array(residuals)
+        _group_run = self
+
+        recalc, done = False, False
+        stats = [None]*len(self.particle_groups)
+        try:
+            for color in color_particle_groups(st, self.particle_groups):
+                pool = _mp.Pool(min(self.processes, len(color)))
+                try:
+                    results = pool.map(_run_particle_group,
+                            [(a, mode) for a in color])
+                finally:
+                    pool.close()
+                    pool.join()
+
+                tiles = []
+                for a, params, values, tile, gstats in results:
+                    comp.ComponentCollection.update(st, params, values)
+                    stats[a] = gstats
+                    if self.save_J and (mode != 'internal'):
+                        self._has_saved_J[a] = True
+
+                    # particles which moved far can push a group's changes
+                    # into the region of another group of the same color
+                    recalc = recalc or any([((tile & t).shape > 0).all()
+                            for t in tiles])
+                    tiles.append(tile)
+            done = True
+        finally:
+            _group_run = None
+            model[:] = st._model
+            residuals[:] = st._residuals
+            st._model, st._residuals = model, residuals
+
+            # the shared model holds the changes of groups whose particles
+            # were never updated here, so it is made again from the params
+            if not done:
+                CLOG.error('Particle group optimization failed, '
+                        'recalculating the model.')
+                st.calculate_model()
+        self.stats.extend(stats)
+
+        if recalc:
+            CLOG.warn('Particle groups changed overlapping regions, '
+                    'recalculating the model.')
+            st.calculate_model()
+        else:
+            st._error = st._calc_error()
+            st._loglikelihood = st._calc_loglikelihood()
 
     def do_run_1(self):
         """Calls LMParticles.do_run_1 for each group of particles."""
@@ -2078,6 +2201,43 @@ class LMParticleGroupCollection(object):
             raise RuntimeError('J, JTJ have not been pre-computed. Call do_run_1 or do_run_2')
         self._do_run(mode='internal')
 
+# the collection being run by _do_run_parallel, inherited by the forked
+# processes of the pool, whose state's model and residuals are in shared
+# memory while it runs
+_group_run = None
+
+try:
+    _mp = multiprocessing.get_context('fork')
+except (AttributeError, ValueError):
+    _mp = multiprocessing
+
+def _shared_array(arr):
+    """A copy of the float64 array `arr` in shared memory."""
+    out = np.frombuffer(_mp.RawArray('d', arr.size), dtype='float64')
+    out = out.reshape(arr.shape)
+    out[:] = arr
+    return out
+
+def _run_particle_group(args):
+    """
+    Optimizes one group of a LMParticleGroupCollection in a forked process,
+    updating the shared model and residuals in place. Returns the group
+    index, its parameters and their new values, the changed region and the
+    termination stats.
+    """
+    a, mode = args
+    lpgc = _group_run
+    st = lpgc.state
+
+    params = st.param_particle(lpgc.particle_groups[a])
+    values0 = np.array(st.get_values(params))
+    stats = lpgc._run_group(a, mode=mode)
+    values1 = np.array(st.get_values(params))
+
+    # the region of both the old and the new particle positions
+    tile = st.get_update_io_tiles(params, values0)[1]
+    return a, params, values1, tile, stats
+
 class AugmentedState(object):
     """
     Augments a state with a set of radii(z) parameters.
@@ -2436,7 +2596,7 @@ def do_levmarq_n_directions(s, directions, max_iter=2, run_length=2,
 
 def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         errtol=1e-2, mode='burn', max_mem=1e9, include_rad=True,
-        do_line_min='default', partial_log=False, dowarn=True):
+        do_line_min='default', partial_log=False, dowarn=True, processes=1):
     """
     Optimizes all the parameters of a state.
 
@@ -2488,6 +2648,9 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         dowarn : Bool, optional
             Whether to log a warning if termination results from finishing
             loops rather than from convergence. Default is True.
+        processes : Int, optional
+            The number of processes over which to optimize the particle
+            groups, see LMParticleGroupCollection. Default is 1.
 
     Returns
     -------
@@ -2601,7 +2764,8 @@ def burn(s, n_loop=6, collect_stats=False, desc='', rz_order=0, fractol=1e-4,
         pstats = do_levmarq_all_particle_groups(s, region_size=40, max_iter=1,
                 do_calc_size=True, run_length=4, eig_update=False,
                 damping=prtl_dmp, fractol=0.1*fractol, collect_stats=
-                collect_stats, max_mem=max_mem, include_rad=include_rad)
+                collect_stats, max_mem=max_mem, include_rad=include_rad,
+                processes=processes)
         all_lp_stats.append(pstats)
         if desc is not None:
             states.save(s, desc=desc)
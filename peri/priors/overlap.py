@@ -5,6 +5,7 @@ import numpy as np
 import scipy as sp
 
 from peri.logger import log
+from peri.special import jit
 
 class HardSphereOverlapNaive(object):
     def __init__(self, pos, rad, zscale=1, prior_type='absolute'):
@@ -158,18 +159,10 @@ class HardSphereOverlapCell(object):
         return dist - dist0
 
     def _dist_diff2(self, p0, p1, r1r2, zs):
-        from scipy import weave
-        code = """
-            double dist = 0.0;
-            for (int i=0; i<3; i++){
-                double d = zs[i]*(p0[i] - p1[i]);
-                dist += d*d;
-            }
-            o[0] = dist - r1r2[0]*r1r2[0];
-        """
-        o = np.zeros(1)
-        weave.inline(code, ["p0", "p1", "r1r2", "zs", "o"])
-        return o[0]
+        return _dist_diff(
+            np.asarray(p0, dtype='float'), np.asarray(p1, dtype='float'),
+            float(np.ravel(r1r2)[0]), np.asarray(zs, dtype='float')
+        )
 
     def _gentiles(self, loc):
         return itertools.product(
@@ -209,6 +202,15 @@ class HardSphereOverlapCell(object):
     def logprior(self):
         return self.logpriors.sum()
 
+@jit
+def _dist_diff(p0, p1, r1r2, zs):
+    """ Squared distance between p0, p1 minus the squared contact distance """
+    dist = 0.0
+    for i in range(3):
+        d = zs[i]*(p0[i] - p1[i])
+        dist += d*d
+    return dist - r1r2*r1r2
+
 def test():
     N = 128
     for i in range(50):
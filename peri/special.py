@@ -1,152 +1,35 @@
+"""
+Fast approximations of special functions. The kernels are compiled with
+numba when it is installed, and otherwise evaluated as numpy expressions.
+
+The approximations of erf and the Bessel functions are those of
+Abramowitz and Stegun: Handbook of Mathematical Functions.
+"""
 import numpy as np
 
 try:
-    from scipy.weave import inline
+    import numba
+    hasnumba = True
 except ImportError as e:
-    try:
-        from weave import inline
-    except ImportError as e:
-        pass
-
-functions = r"""
-double PI = 3.1415926535;
-
-double sgn(double x){
-    return (x > 0) - (x < 0);
-}
-
-/*
-  To use this function, you must provide:
-    * N -- the number of values in the table
-    * table -- the values for each part
-    * dl -- domain left value
-    * dr -- domain right value
-*/
-double periodic_lookup(double x, double *table, double dl, double dr, int N){
-    int r = (int)((x - dl) / (dr - dl));
-    double dx = (dr - dl)/N;
-    double xr = x - (dr - dl)*r;
-
-    int i = (int)(xr / dx); 
-    int j = (i+1)*(i <= N-2);
-    double v0 = table[i];
-    double v1 = table[j];
-
-    double d = (xr - i*dx)/dx;
-    return v0 + (v1-v0)*d;
-}
-
-double fast_erf(double x){
-    double sgn = 1.0;
-
-    if (x < 0){
-        sgn = -1.0;
-        x = -x;
-    }
-
-    double p = 0.47047;
-    double a1 =  0.3480242;
-    double a2 = -0.0958798;
-    double a3 =  0.7478556;
-    double t1 = 1.0/(1 + p*x);
-    double t2 = t1*t1;
-    double t3 = t1*t2;
-    return sgn*(1 - (a1*t1 + a2*t2 + a3*t3)*exp(-x*x));
-}
-
-static union
-{
-    double d;
-    struct
-    {
-        #ifdef LITTLE_ENDIAN
-            int j, i;
-        #else
-            int i, j;
-        #endif
-    } n;
-} _eco;
-
-#define EXP_A (1048576 /M_LN2)
-#define EXP_C 60801
-#define fast_exp(y) (_eco.n.i = EXP_A*(y) + (1072693248 - EXP_C), _eco.d)
-
-double fast_j0(double x){
-    double pi  = 3.14159265;
-    double pi4 = pi/4;
-
-    double a0 =  0.99999990;
-    double a1 = -2.24999239;
-    double a2 =  1.26553572;
-    double a3 = -0.31602189;
-    double a4 =  0.04374224;
-    double a5 = -0.00331563;
-
-    double b0 =  0.79788454;
-    double b1 = -0.00553897;
-    double b2 =  0.00099336;
-    double b3 = -0.00044346; 
-    double b4 =  0.00020445;
-    double b5 = -0.00004959;
-
-    double c0 = -0.04166592;
-    double c1 =  0.00239399;
-    double c2 = -0.00073984;
-    double c3 =  0.00031099;
-    double c4 = -0.00007605;
-
-    double out = 0.0;
-    if (x < 3){
-        double x3 = x*x/9;
-        out = a0 + x3*(a1 + x3*(a2 + x3*(a3 + x3*(a4 + x3*a5))));
-    } else {
-        double x3 = 3/x;
-        double x6 = x3*x3;
-        double f = b0 + x6*(b1 + x6*(b2 + x6*(b3 + x6*(b4 + x6*b5))));
-        double t = x - pi4 + x3*(c0 + x6*(c1 + x6*(c2 + x6*(c3 + x6*c4))));
-        out = 1.0/sqrt(x)*f*cos(t);
-    }
-    return out;
-}
-
-double fast_j1(double x){
-    double pi  = 3.14159265;
-    double pi4 = 3*pi/4;
-
-    double a0 =  0.50000000;
-    double a1 = -0.56249945;
-    double a2 =  0.21093101;
-    double a3 = -0.03952287;
-    double a4 =  0.00439494;
-    double a5 = -0.00028397;
-
-    double b0 =  0.79788459;
-    double b1 =  0.01662008;
-    double b2 = -0.00187002;
-    double b3 =  0.00068519;
-    double b4 = -0.00029440;
-    double b5 =  0.00006952;
-
-    double c0 =  0.12499895;
-    double c1 = -0.00605240;
-    double c2 =  0.00135825;
-    double c3 = -0.00049616;
-    double c4 =  0.00011531;
-
-    double out = 0.0;
-    if (x < 3){
-        double x3 = x*x/9;
-        out = x*(a0 + x3*(a1 + x3*(a2 + x3*(a3 + x3*(a4 + x3*a5)))));
-    } else {
-        double x3 = 3/x;
-        double x6 = x3*x3;
-        double f = b0 + x6*(b1 + x6*(b2 + x6*(b3 + x6*(b4 + x6*b5))));
-        double t = x - pi4 + x3*(c0 + x6*(c1 + x6*(c2 + x6*(c3 + x6*c4))));
-        out = 1.0/sqrt(x)*f*cos(t);
-    }
-    return out;
-}
-"""
+    hasnumba = False
+
+def jit(func):
+    """
+    Compile `func` with numba in nopython mode if it is installed, otherwise
+    return it unchanged. Functions should be written so that they also work
+    as plain numpy expressions.
+    """
+    if hasnumba:
+        return numba.njit(func)
+    return func
+
+def _piecewise(x, cond, small, large):
+    """ Evaluate `small` where `cond` else `large` on the float array `x` """
+    x = np.asarray(x, dtype='float')
+    out = np.empty_like(x)
+    out[cond] = small(x[cond])
+    out[~cond] = large(x[~cond])
+    return out
 
 def build_table(func, N):
     x = np.linspace(0, 2*np.pi, N)
@@ -154,46 +37,76 @@ def build_table(func, N):
     return [N, t, 0, 2*np.pi]
 
 def _eval_table(x, table):
-    code = """
-    for (int i=0; i<N; i++){
-     out[i]=periodic_lookup(x[i], _table, _dl, _dr, _N);
-    }
-    """
-    N = x.ravel().shape[0]
-    xin = x.ravel()
-    out = 0*x
+    """ Periodic linear lookup of `x` in a table from `build_table` """
+    N, t, dl, dr = table
+    t = np.asarray(t)
 
-    _N, _table, _dl, _dr = table
-    inline(code, arg_names=['x', 'N', 'out', '_table', '_dl', '_dr', '_N'],
-            verbose=0, support_code=functions)
-    return out.reshape(x.shape)
+    r = np.trunc((x - dl) / (dr - dl))
+    dx = (dr - dl) / N
+    xr = x - (dr - dl)*r
 
-def fast_j0(x):
-    code = """
-    for (int i=0; i<N; i++){
-       out[i] = fast_j0(x[i]);
-    }
+    i = (xr / dx).astype('int')
+    j = (i + 1)*(i <= N-2)
+    v0, v1 = t[i], t[j]
+    return v0 + (v1 - v0)*(xr - i*dx)/dx
+
+@jit
+def erf_poly(x):
     """
-    N = x.ravel().shape[0]
-    xin = x.ravel()
-    out = 0*x
+    The polynomial part of the approximation to erf for x >= 0,
+    ``erf(x) = 1 - erf_poly(x)*exp(-x*x)``, with absolute error below 2.5e-5
+    """
+    t = 1.0/(1 + 0.47047*x)
+    return t*(0.3480242 + t*(-0.0958798 + t*0.7478556))
+
+@jit
+def fast_erf(x):
+    """ An approximation to erf with absolute error below 2.5e-5 """
+    ax = np.abs(x)
+    return np.sign(x)*(1 - erf_poly(ax)*np.exp(-ax*ax))
+
+@jit
+def _fast_j0_small(x):
+    x3 = x*x/9
+    return (0.99999990 + x3*(-2.24999239 + x3*(1.26553572 + x3*(-0.31602189 +
+        x3*(0.04374224 + x3*-0.00331563)))))
+
+@jit
+def _fast_j0_large(x):
+    x3 = 3/x
+    x6 = x3*x3
+    f = (0.79788454 + x6*(-0.00553897 + x6*(0.00099336 + x6*(-0.00044346 +
+        x6*(0.00020445 + x6*-0.00004959)))))
+    t = x - np.pi/4 + x3*(-0.04166592 + x6*(0.00239399 + x6*(-0.00073984 +
+        x6*(0.00031099 + x6*-0.00007605))))
+    return f*np.cos(t)/np.sqrt(x)
+
+@jit
+def _fast_j1_small(x):
+    x3 = x*x/9
+    return x*(0.50000000 + x3*(-0.56249945 + x3*(0.21093101 + x3*(-0.03952287 +
+        x3*(0.00439494 + x3*-0.00028397)))))
+
+@jit
+def _fast_j1_large(x):
+    x3 = 3/x
+    x6 = x3*x3
+    f = (0.79788459 + x6*(0.01662008 + x6*(-0.00187002 + x6*(0.00068519 +
+        x6*(-0.00029440 + x6*0.00006952)))))
+    t = x - 3*np.pi/4 + x3*(0.12499895 + x6*(-0.00605240 + x6*(0.00135825 +
+        x6*(-0.00049616 + x6*0.00011531))))
+    return f*np.cos(t)/np.sqrt(x)
 
-    inline(code, arg_names=['x', 'N', 'out'], verbose=0, support_code=functions)
-    return out.reshape(x.shape)
+def fast_j0(x):
+    """ Polynomial approximation to the Bessel function J0 for x >= 0 """
+    x = np.asarray(x, dtype='float')
+    return _piecewise(x, x < 3, _fast_j0_small, _fast_j0_large)
 
 def fast_j1(x):
-    code = """
-    for (int i=0; i<N; i++){
-      out[i] = fast_j1(x[i]);
-    }
-    """
-    N = x.ravel().shape[0]
-    xin = x.ravel()
-    out = 0*x
-
-    inline(code, arg_names=['x', 'N', 'out'], verbose=0, support_code=functions)
-    return out.reshape(x.shape)
+    """ Polynomial approximation to the Bessel function J1 for x >= 0 """
+    x = np.asarray(x, dtype='float')
+    return _piecewise(x, x < 3, _fast_j1_small, _fast_j1_large)
 
 def fast_j2(x):
+    """ J2 from the recurrence relation with `fast_j0` and `fast_j1` """
     return 2./(x+1e-15)*fast_j1(x) - fast_j0(x)
-
@@ -9,6 +9,7 @@ import pickle
 
 from functools import partial
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from peri import util, comp, models
 from peri.logger import log as baselog
@@ -17,6 +18,11 @@ log = baselog.getChild('states')
 class UpdateError(Exception):
     pass
 
+def _sumsq(arr):
+    """ Sum of squares of an array (or view of one) without a temporary """
+    inds = 'ijklmnop'[:arr.ndim]
+    return np.einsum('{0},{0}->'.format(inds), arr, arr)
+
 def sample(field, inds=None, slicer=None, flat=True):
     """
     Take a sample from a field given flat indices or a shaped slice
@@ -91,6 +97,23 @@ flat : boolean
     Whether to flatten the sampled item before returning
 """
 
+_modelgraddoc = \
+"""
+analytic : boolean
+    Whether to use the analytic derivatives of the components where they
+    are available, otherwise everything is found by finite differences.
+    Default is True
+
+batch : boolean
+    Whether to perturb parameters whose regions of the model do not overlap
+    at the same time in the finite differences, demultiplexing each of their
+    derivatives from their own region. Default is False
+
+workers : integer
+    Number of threads over which to split the parameters, each working on
+    its own copy of the state so that this state is not changed. Default
+    is 1
+"""
 
 #=============================================================================
 # Super class of State, has all basic components and structure
@@ -497,6 +520,11 @@ class PolyFitState(State):
 # Image state which specializes to components with regions, etc.
 #=============================================================================
 class ImageState(State, comp.ComponentCollection):
+    # sorted sizes to which the update tiles are rounded up, for example
+    # ``util.fft_sizes(max(state.oshape.shape))``, so that the same few tile
+    # shapes recur in the psf and fft caches. None leaves the tiles as is.
+    tile_sizes = None
+
     def __init__(self, image, comps, mdl=models.ConfocalImageModel(), sigma=0.04,
             priors=None, pad=24, model_as_data=False):
         """
@@ -591,6 +619,7 @@ class ImageState(State, comp.ComponentCollection):
 
         self._model = np.zeros(self._data.shape, dtype=np.float64)
         self._residuals = np.zeros(self._data.shape, dtype=np.float64)
+        self._scratchbuf = np.zeros(0)
         self.calculate_model()
 
     def set_tile_full(self):
@@ -610,6 +639,7 @@ class ImageState(State, comp.ComponentCollection):
     def calculate_model(self):
         self._model[:] = self._calc_model()
         self._residuals[:] = self._calc_residuals()
+        self._error = self._calc_error()
         self._loglikelihood = self._calc_loglikelihood()
         self._logprior = self._calc_logprior()
 
@@ -631,6 +661,15 @@ class ImageState(State, comp.ComponentCollection):
     def loglikelihood(self):
         return self._loglikelihood
 
+    @property
+    def error(self):
+        """
+        Class property: Sum of the squared errors,
+        :math:`E = \sum_i (D_i - M_i(\\theta))^2`, kept up to date by
+        each update
+        """
+        return self._error
+
     def get_update_io_tiles(self, params, values):
         """
         Get the tiles corresponding to a particular section of image needed to
@@ -657,12 +696,31 @@ class ImageState(State, comp.ComponentCollection):
         # into the image itself for the outer slice which we will call outer
         outer = otile.pad((ptile.shape+1)//2)
         inner, outer = outer.reflect_overhang(self.oshape)
+        if self.tile_sizes is not None:
+            outer = self._quantize_tile(util.Tile.intersection(outer, self.oshape))
         iotile = inner.translate(-outer.l)
 
         outer = util.Tile.intersection(outer, self.oshape)
         inner = util.Tile.intersection(inner, self.oshape)
         return outer, inner, iotile
 
+    def _quantize_tile(self, tile):
+        """
+        Grow `tile` about its center to the next sizes in `tile_sizes`,
+        shifting it to stay inside the image and clipping it to the image
+        size. The grown tile contains the original one.
+        """
+        sizes = np.asarray(self.tile_sizes)
+        ind = np.searchsorted(sizes, tile.shape)
+        shape = np.where(
+            ind < len(sizes), sizes[np.minimum(ind, len(sizes)-1)], tile.shape
+        )
+        shape = np.minimum(shape, self.oshape.shape)
+
+        left = tile.l - (shape - tile.shape)//2
+        left = np.clip(left, self.oshape.l, self.oshape.r - shape)
+        return util.Tile(left, left + shape)
+
     def update(self, params, values):
         """
         Actually perform an image (etc) update based on a set of params and
@@ -685,39 +743,398 @@ class ImageState(State, comp.ComponentCollection):
         # have all components update their tiles
         self.set_tile(otile)
 
-        oldmodel = self._model[itile.slicer].copy()
+        # the part of the residuals which counts towards the error
+        rslicer = util.Tile.intersection(itile, self.ishape).slicer
+        error0 = _sumsq(self._residuals[rslicer])
+
+        model = self._model[itile.slicer]
+        residuals = self._residuals[itile.slicer]
 
         # here we diverge depending if there is only one component update
         # (so that we may calculate a variation / difference image) or if many
         # parameters are being update (should just update the whole model).
-        if len(comps) == 1 and self.mdl.get_difference_model(comps[0].category):
+        # the psf is an operator rather than a field, so it has no difference
+        # image and is always updated in full.
+        if (len(comps) == 1 and comps[0].category != 'psf' and
+                self.mdl.get_difference_model(comps[0].category)):
             comp = comps[0]
-            model0 = copy.deepcopy(comp.get())
+
+            # the field may be a view of the component's storage, keep a copy
+            # of the old one in a buffer which is reused for the difference
+            model0 = comp.get()
+            if isinstance(model0, np.ndarray):
+                model0 = self._scratch(model0)
+
             super(ImageState, self).update(params, values)
-            model1 = copy.deepcopy(comp.get())
+            model1 = comp.get()
+
+            if isinstance(model0, np.ndarray):
+                diff = np.subtract(model1, model0, out=model0)
+            else:
+                diff = model1 - model0
 
-            diff = model1 - model0
             diff = self.mdl.evaluate(
                 self.comps, 'get', diffmap={comp.category: diff}
             )
 
-            if isinstance(model0, (float, int)):
-                self._model[itile.slicer] += diff
-            else:
-                self._model[itile.slicer] += diff[iotile.slicer]
+            if not isinstance(model0, (float, int)):
+                diff = diff[iotile.slicer]
+            model += diff
+            residuals -= diff
         else:
             super(ImageState, self).update(params, values)
 
             # allow the model to be evaluated using our components
             diff = self.mdl.evaluate(self.comps, 'get')
-            self._model[itile.slicer] = diff[iotile.slicer]
+            model[:] = diff[iotile.slicer]
+            np.subtract(self._data[itile.slicer], model, out=residuals)
+
+        # keep the error and loglikelihood up to date from the change in the
+        # residuals of the tile alone
+        derror = _sumsq(self._residuals[rslicer]) - error0
+        self._error += derror
+        self._loglikelihood -= 0.5 * derror / self.sigma**2
+        return True
+
+    def _scratch(self, arr):
+        """
+        A copy of `arr` in a buffer which is kept between updates (and grown
+        as needed) so that updates do not allocate a new array each time.
+        """
+        buf = self._scratchbuf
+        if buf.size < arr.size or buf.dtype != arr.dtype:
+            buf = self._scratchbuf = np.empty(arr.size, dtype=arr.dtype)
 
-        newmodel = self._model[itile.slicer].copy()
+        out = buf[:arr.size].reshape(arr.shape)
+        out[...] = arr
+        return out
 
-        # use the model image update to modify other class variables which
-        # are hard to compute globally for small local updates
-        self.update_from_model_change(oldmodel, newmodel, itile)
-        return True
+    def build_funcs(self):
+        """
+        In addition to the functions built by :class:`~peri.states.State`,
+        the model gradient and J use the analytic derivatives of components
+        where they are available (see ``_grad_model``).
+        """
+        super(ImageState, self).build_funcs()
+
+        self.gradmodel = partial(self._grad_model, sign=1)
+        self.J = partial(self._grad_model, sign=-1)
+        self.gradmodel_e = partial(self._grad_model, sign=1, error=True)
+        self.J_e = partial(self._grad_model, sign=-1, error=True)
+        self.gradmodel.__doc__ = _graddoc + _modelgraddoc + _sampledoc
+        self.J.__doc__ = _graddoc + _modelgraddoc + _sampledoc
+
+    def _grad_model_analytic(self, param):
+        """
+        Derivative of the model with respect to a single parameter, found by
+        pushing the analytic derivative of a component's field through the
+        difference model of its category. Since the difference models are
+        linear in the varied component, this is exact. The derivative of an
+        operator (the psf) is itself an operator which is evaluated on the
+        update tile. Returns the inner tile and the derivative of the model
+        on that tile or None if the derivative is not available.
+        """
+        comps = self.affected_components(param)
+        if len(comps) != 1:
+            return None
+
+        comp = comps[0]
+        if not self.mdl.get_difference_model(comp.category):
+            return None
+
+        grad = comp.get_field_gradient(param)
+        if grad is None:
+            return None
+
+        otile, itile, iotile = self.get_update_io_tiles(
+            param, self.get_values(param)
+        )
+        if otile is None:
+            return None
+
+        # place the field derivative into the update tile and evaluate the
+        # difference model there
+        ftile, dfield = grad
+        self.set_tile(otile)
+
+        if callable(dfield):
+            field = dfield
+        else:
+            field = np.zeros(otile.shape)
+            tile = util.Tile.intersection(ftile, otile)
+            field[tile.translate(-otile.l).slicer] = dfield[tile.translate(-ftile.l).slicer]
+
+        diff = self.mdl.evaluate(
+            self.comps, 'get', diffmap={comp.category: field}
+        )
+        return itile, diff[iotile.slicer]
+
+    def _disjoint_param_groups(self, params, dl=2e-5):
+        """
+        Greedily group `params` so that the padded update tiles of the
+        parameters in a group do not overlap, so each parameter's change of
+        the model can be evaluated on its own tile while the whole group is
+        perturbed. Only parameters of a single component which has a
+        difference model are grouped together. Returns a list of groups,
+        each a list of (index, io tiles) pairs, where the io tiles are those
+        of ``get_update_io_tiles`` or None for parameters in a group of
+        their own.
+        """
+        groups, bounds = [], []
+
+        for i, p in enumerate(params):
+            comps = self.affected_components(p)
+            if (len(comps) != 1 or comps[0].category == 'psf' or
+                    not self.mdl.get_difference_model(comps[0].category)):
+                groups.append([(i, None)])
+                continue
+
+            values = np.array(self.get_values(p)) + dl
+            tiles = self.get_update_io_tiles(p, values)
+            otile = tiles[0]
+
+            if otile is None or otile == self.oshape:
+                groups.append([(i, None)])
+                continue
+
+            # first group of the same component with no overlapping tiles
+            for g, (c, l, r) in enumerate(bounds):
+                if c is not comps[0]:
+                    continue
+                if ((np.minimum(r, otile.r) - np.maximum(l, otile.l)) > 0).all(axis=1).any():
+                    continue
+
+                groups[g].append((i, tiles))
+                bounds[g] = (c, np.vstack([l, otile.l]), np.vstack([r, otile.r]))
+                break
+            else:
+                # groups of local tiles are indexed first so that the bounds
+                # line up with the group index
+                groups.insert(len(bounds), [(i, tiles)])
+                bounds.append((comps[0], otile.l[None], otile.r[None]))
+        return groups
+
+    def _grad_model_group(self, params, tiles, dl=2e-5, rts=False):
+        """
+        Finite difference changes of the model for a group of parameters of
+        one component whose update tiles do not overlap. The component is
+        updated once for all of them and the difference model is evaluated
+        once on the tile bounding the group, from which each parameter's
+        change of the model is taken on its own inner tile. If the bounding
+        tile is larger than the tiles together, the difference model is
+        evaluated on each tile instead. Returns a list of these changes.
+        Only the component changes, so with `rts` it is returned to its
+        values and otherwise the model is updated with the changes.
+        """
+        comp = self.affected_components(params[0])[0]
+        values = np.array(self.get_values(params))
+
+        gtile = util.Tile.boundingtile([t[0] for t in tiles])
+        if gtile.volume <= sum([t[0].volume for t in tiles]):
+            # (outer tile, inner tile relative to it) to evaluate on
+            evals = [(gtile, [t[1].translate(-gtile.l) for t in tiles])]
+        else:
+            evals = [(otile, [iotile]) for otile, _, iotile in tiles]
+
+        fields = []
+        for otile, _ in evals:
+            self.set_tile(otile)
+            fields.append(np.array(comp.get(), copy=True))
+
+        super(ImageState, self).update(params, values+dl)
+
+        diffs = []
+        for (otile, iotiles), field in zip(evals, fields):
+            self.set_tile(otile)
+            field = np.subtract(comp.get(), field, out=field)
+            diff = self.mdl.evaluate(
+                self.comps, 'get', diffmap={comp.category: field}
+            )
+            diffs.extend([diff[t.slicer] for t in iotiles])
+
+        if rts:
+            super(ImageState, self).update(params, values)
+            return [d / dl for d in diffs]
+
+        for (_, itile, _), d in zip(tiles, diffs):
+            rslicer = util.Tile.intersection(itile, self.ishape).slicer
+            error0 = _sumsq(self._residuals[rslicer])
+
+            self._model[itile.slicer] += d
+            self._residuals[itile.slicer] -= d
+
+            derror = _sumsq(self._residuals[rslicer]) - error0
+            self._error += derror
+            self._loglikelihood -= 0.5 * derror / self.sigma**2
+        return [d / dl for d in diffs]
+
+    def _clone(self):
+        """
+        A copy of the state which may be updated independently of this one,
+        for example to calculate gradients in parallel. The (read-only) image
+        data is shared with this state, the components are cloned without
+        initializing them again (see :func:`peri.comp.comp.Component.clone`).
+        """
+        state = self.__class__.__new__(self.__class__)
+        state.__dict__.update(self.__dict__)
+
+        comp.ComponentCollection.__init__(
+            state, comps=[c.clone() for c in self.comps]
+        )
+        state.set_model(copy.deepcopy(self.mdl))
+        state._model = self._model.copy()
+        state._residuals = self._residuals.copy()
+        state._scratchbuf = np.zeros(0)
+        state.build_funcs()
+        return state
+
+    def _grad_model_parallel(self, params, workers, out, error=False,
+            rts=False, **kwargs):
+        """
+        Split the gradient of the model wrt `params` into `workers` blocks of
+        parameters, each calculated in a thread on its own clone of the
+        state, writing into the output arrays `out`. The clones are dropped
+        afterwards. Without `rts`, this state is left with the parameters
+        where the clones left them, as after the serial calculation.
+        """
+        blocks = np.array_split(np.arange(len(params)), workers)
+        blocks = [b for b in blocks if len(b) > 0]
+        clones = [self._clone() for b in blocks]
+
+        def _run(job):
+            state, block = job
+            i0, i1 = block[0], block[-1]+1
+            o = [out[0][i0:i1], out[1][i0:i1]] if error else out[i0:i1]
+            state._grad_model(
+                params[i0:i1], out=o, error=error, rts=rts, workers=1,
+                **kwargs
+            )
+
+        pool = ThreadPool(len(blocks))
+        try:
+            pool.map(_run, list(zip(clones, blocks)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if not rts:
+            values = np.array(self.get_values(params))
+            moved = np.array(sum([
+                state.get_values([params[i] for i in block])
+                for state, block in zip(clones, blocks)
+            ], []))
+            changed = np.nonzero(moved != values)[0]
+            if len(changed) > 0:
+                self.update([params[i] for i in changed], moved[changed])
+        return out
+
+    def _grad_model(self, params=None, dl=2e-5, rts=False, out=None,
+            sign=1, analytic=True, batch=False, error=False, workers=1,
+            **kwargs):
+        """
+        Gradient of the model (`sign` = 1) or of the residuals (`sign` = -1)
+        wrt a set of parameters. Parameters whose component provides an
+        analytic derivative are calculated with ``_grad_model_analytic``, the
+        rest through finite differences, which with `batch` are done together
+        for parameters whose update regions do not overlap. If `error`, the
+        gradient of the state's error is returned as well. (see _graddoc)
+        """
+        if params is None:
+            params = self.param_all()
+
+        ps = util.listify(params)
+
+        def funct(**kw):
+            return sign*sample(self.model, **kw).copy()
+
+        def funct_e(**kw):
+            return funct(**kw), self.error
+
+        f0 = funct(**kwargs)
+        if out is not None:
+            grad, gerr = out if error else (out, None)  # reference
+        else:
+            grad = np.zeros((len(ps),) + f0.shape)
+            gerr = np.zeros(len(ps)) if error else None
+
+        if workers > 1 and len(ps) > 1:
+            return self._grad_model_parallel(
+                ps, workers, [grad, gerr] if error else grad, dl=dl, rts=rts,
+                sign=sign, analytic=analytic, batch=batch, error=error,
+                **kwargs
+            )
+
+        # the analytic derivatives and their changes of the error are taken
+        # at the current values, so before any finite differences (which
+        # without rts leave the state moved) are calculated
+        grads = [
+            self._grad_model_analytic(p) if analytic else None for p in ps
+        ]
+
+        field = np.zeros(self.model.shape)
+        def _place(i, itile, diff, witherror=error):
+            tile = util.Tile.intersection(itile, self.ishape)
+            dslicer = tile.translate(-itile.l).slicer
+            islicer = tile.translate(-self.ishape.l).slicer
+
+            field[islicer] = diff[dslicer]
+            grad[i] = sign*sample(field, **kwargs)
+            field[islicer] = 0
+
+            if witherror:
+                res = self._residuals[tile.slicer]
+                gerr[i] = -2*np.dot(res.ravel(), diff[dslicer].ravel())
+
+        for i, g in enumerate(grads):
+            if g is not None:
+                _place(i, *g)
+
+        numeric = [i for i in range(len(ps)) if grads[i] is None]
+        if batch:
+            groups = self._disjoint_param_groups([ps[i] for i in numeric], dl=dl)
+            groups = [[(numeric[j], t) for j, t in g] for g in groups]
+        else:
+            groups = [[(i, None)] for i in numeric]
+
+        for group in groups:
+            if len(group) == 1:
+                i = group[0][0]
+                if error:
+                    grad[i], gerr[i] = self._grad_one_param(
+                        funct_e, ps[i], dl=dl, rts=rts, nout=2, **kwargs
+                    )
+                else:
+                    grad[i] = self._grad_one_param(
+                        funct, ps[i], dl=dl, rts=rts, **kwargs
+                    )
+                continue
+
+            # perturb the whole group at once and pick out each parameter's
+            # change of the model on its own tile
+            idx = [i for i, _ in group]
+            tiles = [t for _, t in group]
+
+            if error:
+                # the tiles are disjoint so the change in the error splits
+                # into the change on each of the tiles
+                res = [
+                    self._residuals[util.Tile.intersection(t[1], self.ishape).slicer].copy()
+                    for t in tiles
+                ]
+
+            diffs = self._grad_model_group(
+                [ps[i] for i in idx], tiles, dl=dl, rts=rts
+            )
+            for i, (_, itile, _), diff in zip(idx, tiles, diffs):
+                _place(i, itile, diff, witherror=False)
+
+            if error:
+                for j, (i, (_, itile, _)) in enumerate(zip(idx, tiles)):
+                    tile = util.Tile.intersection(itile, self.ishape)
+                    d = diffs[j][tile.translate(-itile.l).slicer]*dl
+                    gerr[i] = (_sumsq(res[j] - d) - _sumsq(res[j])) / dl
+
+        return [grad, gerr] if error else grad
 
     def get(self, name):
         """ Return component by category name """
@@ -738,6 +1155,9 @@ class ImageState(State, comp.ComponentCollection):
     def _calc_residuals(self):
         return self._data - self._model
 
+    def _calc_error(self):
+        return _sumsq(self.residuals)
+
     def _calc_logprior(self):
         """Allows for fast local updates of log-priors"""
         return 0. # FIXME this should be incorporated somewhere
@@ -758,15 +1178,6 @@ class ImageState(State, comp.ComponentCollection):
         self.sigma = sigma
         self._loglikelihood = self._calc_loglikelihood()
 
-    def update_from_model_change(self, oldmodel, newmodel, tile):
-        """
-        Update various internal variables from a model update from oldmodel to
-        newmodel for the tile `tile`
-        """
-        self._loglikelihood -= self._calc_loglikelihood(oldmodel, tile=tile)
-        self._loglikelihood += self._calc_loglikelihood(newmodel, tile=tile)
-        self._residuals[tile.slicer] = self._data[tile.slicer] - newmodel
-
     def exports(self):
         raise NotImplementedError('inherited but not relevant')
 
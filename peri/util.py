@@ -8,6 +8,7 @@ import time
 import inspect
 import itertools
 import numpy as np
+from collections import OrderedDict
 from contextlib import contextmanager
 
 from peri import initializers
@@ -31,6 +32,32 @@ def oddify(num):
     """
     return num + (num % 2 == 0)
 
+def fft_sizes(maxsize, primes=(2, 3, 5, 7), ratio=1.1):
+    """
+    A small set of sizes up to ``maxsize`` which are products of ``primes``,
+    and so quick to Fourier transform, each at least ``ratio`` times the last.
+
+    Examples
+    --------
+    >>> fft_sizes(30)
+    [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 14, 16, 18, 20, 24, 27, 30]
+    """
+    sizes = [1]
+    for p in primes:
+        grown = []
+        for s in sizes:
+            while s <= maxsize:
+                grown.append(s)
+                s *= p
+        sizes = grown
+    sizes = sorted(set(sizes))
+
+    out = sizes[:1]
+    for s in sizes[1:]:
+        if s >= ratio*out[-1]:
+            out.append(s)
+    return out
+
 def listify(a):
     """
     Convert a scalar ``a`` to a list and all iterables to list as well.
@@ -548,6 +575,9 @@ class Tile(CompatibilityPatch):
             return True
         return ~self.__eq__(other)
 
+    def __hash__(self):
+        return hash((tuple(self.l), tuple(self.r)))
+
     def __and__(self, other):
         return Tile.intersection(self, other)
 
@@ -1113,6 +1143,37 @@ def memoize(cache_max_size=1e9):
 
     return memoize_inner
 
+class TileCache(object):
+    def __init__(self, max_size=2**27):
+        """
+        A small least-recently-used cache of arrays keyed on the tiles they
+        were evaluated on, holding at most `max_size` bytes. Arrays larger
+        than that are never stored.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._cache = OrderedDict()
+
+    def get(self, tile, func):
+        """ The array for `tile`, calling ``func(tile)`` if it is not cached """
+        key = (tuple(tile.l), tuple(tile.r))
+        if key in self._cache:
+            ans = self._cache.pop(key)
+            self._cache[key] = ans
+            return ans
+
+        ans = func(tile)
+        if ans.nbytes <= self.max_size:
+            self._cache[key] = ans
+            self.size += ans.nbytes
+            while self.size > self.max_size:
+                self.size -= self._cache.popitem(last=False)[1].nbytes
+        return ans
+
+    def clear(self):
+        self._cache.clear()
+        self.size = 0
+
 #=============================================================================
 # patching docstrings of sub-classes
 #=============================================================================
@@ -0,0 +1,58 @@
+"""
+Benchmark of the fast kernels in peri.special and the fast sphere profile
+against the implementations they replace. Run with and without numba
+installed to compare the compiled kernels with the numpy fallbacks.
+"""
+from __future__ import print_function
+
+import timeit
+import numpy as np
+from scipy.special import erf, j0, j1
+
+from peri import special
+from peri.comp import objs
+from peri.priors import overlap
+
+def bench(name, func, number=50):
+    func()
+    t = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('{:<40} {:10.3f} ms'.format(name, 1e3*t))
+    return t
+
+def sphere_profiles(radius=5.0, size=2**18):
+    rng = np.random.RandomState(0)
+    dr = (rng.rand(size) - 0.5)*8
+
+    ttrim = bench('sphere_analytical_gaussian_trim',
+        lambda: objs.sphere_analytical_gaussian_trim(dr, radius))
+    tfast = bench('sphere_analytical_gaussian_fast',
+        lambda: objs.sphere_analytical_gaussian_fast(dr, radius))
+    print('speedup over trim: {:.2f}x\n'.format(ttrim / tfast))
+
+def bessel_functions(size=2**18):
+    x = np.linspace(0, 30, size)
+
+    bench('scipy.special.erf', lambda: erf(x))
+    bench('special.fast_erf', lambda: special.fast_erf(x))
+    bench('scipy.special.j0', lambda: j0(x))
+    bench('special.fast_j0', lambda: special.fast_j0(x))
+    bench('scipy.special.j1', lambda: j1(x))
+    bench('special.fast_j1', lambda: special.fast_j1(x))
+    bench('special.fast_j2', lambda: special.fast_j2(x))
+    print()
+
+def overlap_distance(number=10000):
+    cell = overlap.HardSphereOverlapCell.__new__(overlap.HardSphereOverlapCell)
+    p0, p1, zs = np.random.rand(3), np.random.rand(3), np.ones(3)
+    r1r2 = np.array(0.1)
+
+    bench('HardSphereOverlapCell._dist_diff',
+        lambda: cell._dist_diff(p0, p1, r1r2, zs), number=number)
+    bench('HardSphereOverlapCell._dist_diff2',
+        lambda: cell._dist_diff2(p0, p1, r1r2, zs), number=number)
+
+if __name__ == '__main__':
+    print('numba available: {}\n'.format(special.hasnumba))
+    sphere_profiles()
+    bessel_functions()
+    overlap_distance()
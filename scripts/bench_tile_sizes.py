@@ -0,0 +1,63 @@
+"""
+Cache hit ratio of the psf kernels during particle updates on the demo image
+with the update tiles as they are and rounded up to a few FFT-friendly sizes
+(see :attr:`peri.states.ImageState.tile_sizes`). Run from the repository root.
+"""
+from __future__ import print_function
+
+import time
+import numpy as np
+
+from peri import util, states
+from peri.comp import objs, ilms, comp, psfs, exactpsf
+
+IMAGE = 'docs/_static/small_confocal_image.tif'
+POSITIONS = 'docs/_static/particle-positions.npy'
+
+def create_state(psf):
+    particles = objs.PlatonicSpheresCollection(np.load(POSITIONS), 5.0)
+    ilm = ilms.BarnesStreakLegPoly2P1D(npts=(16, 10, 8, 4), zorder=8)
+    bkg = ilms.LegendrePoly2P1D(order=(7, 2, 2), category='bkg')
+    offset = comp.GlobalScalar(name='offset', value=0.)
+    return states.ImageState(
+        util.RawImage(IMAGE), [particles, ilm, bkg, offset, psf], pad=16
+    )
+
+def cache_stats(psf):
+    """ Total (hits, misses) of the kernel caches of `psf` """
+    if isinstance(psf, exactpsf.ExactPSF):
+        info = psf.kcache_info()
+        return info['hits'], info['misses']
+    caches = getattr(psf, '_memoize_caches', {}).values()
+    return sum([c['hits'] for c in caches]), sum([c['misses'] for c in caches])
+
+def particle_sweep(s, step=0.1, seed=0):
+    """ Move each particle by a small random step and back again """
+    rng = np.random.RandomState(seed)
+    for i in range(s.obj_get_positions().shape[0]):
+        params = s.param_particle_pos(i)
+        values = np.array(s.get_values(params))
+        s.update(params, values + step*rng.randn(3))
+        s.update(params, values)
+
+def bench(name, psf):
+    for quantize in [False, True]:
+        s = create_state(psf())
+        if quantize:
+            s.tile_sizes = util.fft_sizes(max(s.oshape.shape))
+        h0, m0 = cache_stats(s.get('psf'))
+        t = time.time()
+        particle_sweep(s)
+        t = time.time() - t
+        h1, m1 = cache_stats(s.get('psf'))
+
+        hits, misses = h1 - h0, m1 - m0
+        print('{:<20} {:<9} hit ratio {:6.1%} ({} misses) {:5.2f} s, '
+                'error {:.6f}'.format(
+            name, 'fft sizes' if quantize else 'as is',
+            hits / float(hits + misses), misses, t, s.error
+        ))
+
+if __name__ == '__main__':
+    bench('AnisotropicGaussian', psfs.AnisotropicGaussian)
+    bench('FixedSSChebLinePSF', exactpsf.FixedSSChebLinePSF)
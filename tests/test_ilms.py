@@ -0,0 +1,155 @@
+import pickle
+import unittest
+import numpy as np
+from numpy.polynomial.legendre import legval
+from numpy.polynomial.chebyshev import chebval
+
+from peri.comp import ilms
+from peri.test import init
+from peri.util import Tile
+
+class BarnesUpdateToleranceTestCase(unittest.TestCase):
+    """
+    Updates of barnes coefficients truncated to where their columns of the
+    basis exceed `update_tolerance`, against full updates
+    """
+    def _bound(self, ilm, dv):
+        """ Largest change of the field left out of the update tile """
+        scale = abs(dv * ilm.scale) * np.abs(1 + ilm.poly).max()
+        return ilm.update_tolerance * scale
+
+    def test_field(self):
+        ilm = ilms.BarnesXYLegPolyZ(
+            npts=(12, 12), zorder=1, shape=Tile([4, 48, 48])
+        )
+        rng = np.random.RandomState(10)
+        params = ilm.param_barnes_pts()
+        ilm.update(params, 0.1*rng.randn(len(params)))
+
+        truncated = 0
+        for p in params[::7]:
+            tile = ilm.get_update_tile(p, 0)
+            field0 = ilm.get().copy()
+            dv = 0.1
+            ilm.update(p, ilm.get_values(p) + dv)
+
+            change = ilm.get() - field0
+            change[tile.slicer] = 0
+            self.assertLessEqual(np.abs(change).max(), self._bound(ilm, dv))
+            truncated += (tile.shape < ilm.shape.shape).any()
+        self.assertGreater(truncated, 0)
+
+    def test_model(self):
+        s = init.create_many_particle_state(imsize=24, N=3, radius=4.0, seed=10)
+        ilm = s.get('ilm')
+        ilm.update_tolerance = 1e-4
+
+        params = ilm.param_barnes_pts()[::4]
+        dv = 0.1
+        error = 0
+        for p in params:
+            s.update(p, s.get_values(p) + dv)
+            error += self._bound(ilm, dv)
+        self.assertLess(ilm.get_update_tile(params[0], 0).volume, ilm.shape.volume)
+
+        model = s.model.copy()
+        s.calculate_model()
+        self.assertLessEqual(np.abs(model - s.model).max(), error)
+
+class Polynomial2P1DTestCase(unittest.TestCase):
+    """ The factored fields against the full polynomial in (z, y, x) """
+    classes = [
+        (ilms.Polynomial2P1D, lambda x, n: x**n),
+        (ilms.LegendrePoly2P1D, lambda x, n: legval(x, np.eye(n+1)[n])),
+        (ilms.ChebyshevPoly2P1D, lambda x, n: chebval(x, np.eye(n+1)[n])),
+    ]
+
+    def _full_field(self, ilm, term):
+        z, y, x = ilm.r
+        xy, q = 0, 0
+        for p, v in zip(ilm.params, ilm.values):
+            if p in ilm.xy_param:
+                i, j = ilm.xy_param[p]
+                xy = xy + v * term(x, i) * term(y, j)
+            else:
+                q = q + v * term(z, ilm.z_param[p][0])
+        field = xy * (1 + q) if ilm.operation == '*' else xy + 1 + q
+        return np.broadcast_to(field, ilm.shape.shape)
+
+    def test_fields(self):
+        rng = np.random.RandomState(10)
+        shape = Tile([12, 16, 20])
+        tiles = [shape, Tile([2, 5, 3], [9, 16, 12]), Tile([11, 0, 19], [12, 1, 20])]
+
+        for cls, term in self.classes:
+            for operation in ['*', '+']:
+                ilm = cls(order=(3, 2, 3), operation=operation, shape=shape)
+                ilm.update(ilm.params, rng.randn(len(ilm.params)))
+
+                # single parameter updates change only one of the factors
+                for p in ilm.params[::2]:
+                    ilm.update(p, ilm.get_values(p) + rng.randn())
+
+                goal = self._full_field(ilm, term)
+                self.assertLess(np.abs(ilm.field - goal).max(), 1e-12)
+                for tile in tiles:
+                    ilm.set_tile(tile)
+                    out = ilm.get()
+                    sub = goal[tile.slicer]
+                    self.assertLess(np.abs(out - sub).max(), 1e-12)
+
+class LazyFieldTestCase(unittest.TestCase):
+    """ Fields evaluated per tile from the coefficients against stored ones """
+    components = [
+        (ilms.Polynomial3D, {'order': (2, 3, 2)}),
+        (ilms.LegendrePoly3D, {'order': (2, 3, 2)}),
+        (ilms.BarnesStreakLegPoly2P1D, {'npts': (6, 4), 'zorder': 2}),
+        (ilms.BarnesXYLegPolyZ, {'npts': (4, 5), 'zorder': 2}),
+    ]
+
+    def _pair(self, cls, kwargs, shape):
+        stored = cls(shape=shape, **kwargs)
+        lazy = cls(**kwargs)
+        lazy.lazy_field = True
+        lazy.tile_cache_size = 8*200
+        lazy.set_shape(shape, shape)
+        return stored, lazy
+
+    def _check(self, stored, lazy, tiles):
+        self.assertNotIn('field', lazy.__dict__)
+        for _ in range(2):
+            # the second time through the small cache has evicted tiles
+            for tile in tiles:
+                stored.set_tile(tile)
+                lazy.set_tile(tile)
+                self.assertLess(np.abs(lazy.get() - stored.get()).max(), 1e-12)
+            self.assertLessEqual(lazy._tiles.size, lazy.tile_cache_size)
+
+    def test_fields(self):
+        rng = np.random.RandomState(10)
+        shape = Tile([8, 16, 20])
+        tiles = [
+            shape, Tile([2, 5, 3], [7, 9, 12]), Tile([0, 0, 19], [8, 1, 20]),
+            Tile([2, 5, 3], [7, 9, 12])
+        ]
+        for cls, kwargs in self.components:
+            stored, lazy = self._pair(cls, kwargs, shape)
+            params = stored.params
+            values = 0.1*rng.randn(len(params))
+            stored.update(params, values)
+            lazy.update(params, values)
+            self._check(stored, lazy, tiles)
+
+            # the cached tiles do not outlive an update
+            for p in params[::5]:
+                v = stored.get_values(p) + 0.1
+                stored.update(p, v)
+                lazy.update(p, v)
+            self._check(stored, lazy, tiles)
+
+            lazy = pickle.loads(pickle.dumps(lazy))
+            self.assertTrue(lazy.lazy_field)
+            self._check(stored, lazy, tiles)
+
+if __name__ == '__main__':
+    unittest.main()
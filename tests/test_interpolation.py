@@ -0,0 +1,76 @@
+import unittest
+import numpy as np
+from scipy import sparse
+
+from peri import interpolation
+from peri.comp import ilms
+from peri.util import Tile
+
+class BarnesOperatorTestCase(unittest.TestCase):
+    """ The Barnes interpolations as linear operators on their data """
+    def setUp(self):
+        self.rng = np.random.RandomState(10)
+
+    def _check(self, b, rvecs, blocksize=None):
+        op = b.operator(rvecs, blocksize=blocksize)
+        self.assertEqual(sparse.issparse(op), bool(blocksize))
+        for _ in range(3):
+            b.d = self.rng.randn(len(b.x))
+            goal = b(rvecs)
+            self.assertLess(np.abs(op.dot(b.d) - goal).max(), 1e-12)
+
+    def test_1d(self):
+        x = np.linspace(-1, 1, 12)
+        rvecs = np.linspace(-1, 1, 101)
+        for clip in [False, True]:
+            b = interpolation.BarnesInterpolation1D(
+                x, np.zeros(x.size), filter_size=0.1, damp=0.9,
+                iterations=3, clip=clip
+            )
+            self._check(b, rvecs)
+            self._check(b, rvecs, blocksize=16)
+
+    def test_nd(self):
+        x = self.rng.rand(30, 2)
+        rvecs = self.rng.rand(200, 2)
+        for clip in [False, True]:
+            b = interpolation.BarnesInterpolationND(
+                x, np.zeros(len(x)), filter_size=0.2, damp=0.9,
+                iterations=3, clip=clip, blocksize=50
+            )
+            self._check(b, rvecs)
+            self._check(b, rvecs, blocksize=64)
+
+class BarnesBasisTestCase(unittest.TestCase):
+    """ The barnes part of the ilms from their bases and interpolating """
+    def _randomize(self, ilm):
+        rng = np.random.RandomState(10)
+        params = ilm.param_barnes_pts()
+        ilm.update(params, rng.randn(len(params)))
+
+    def test_streaks(self):
+        for local_updates in [True, False]:
+            ilm = ilms.BarnesStreakLegPoly2P1D(
+                npts=(6, 4), zorder=1, local_updates=local_updates,
+                shape=Tile([4, 20, 24])
+            )
+            self._randomize(ilm)
+
+            goal = sum([
+                ilm._barnes_poly(n) * ilm._barnes_interpolator(n)(ilm.b_out)
+                for n in range(len(ilm.npts))
+            ])
+            out = ilm._barnes_full()[0]
+            self.assertLess(np.abs(out - goal).max(), 1e-12)
+
+    def test_xy(self):
+        ilm = ilms.BarnesXYLegPolyZ(
+            npts=(4, 5), zorder=1, shape=Tile([4, 16, 18])
+        )
+        self._randomize(ilm)
+
+        goal = ilm._barnes(ilm.b_out)
+        self.assertLess(np.abs(ilm._barnes_val() - goal).max(), 1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
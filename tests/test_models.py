@@ -0,0 +1,78 @@
+import ast
+import inspect
+import unittest
+import numpy as np
+
+from peri import models
+
+def _model_equations():
+    """ Every equation in the model dicts of the models in peri.models """
+    eqs = []
+    for name, cls in inspect.getmembers(models, inspect.isclass):
+        if issubclass(cls, models.Model) and cls is not models.Model:
+            eqs.extend(cls().modelstr.values())
+    return eqs
+
+class ExpressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(10)
+        self.equations = _model_equations()
+
+    def _variables(self, eq, shapes, dtypes):
+        """ Values for the symbols in `eq`, cycling through shapes and dtypes """
+        tree = ast.parse(eq, mode='eval')
+        funcs = set([
+            n.func.id for n in ast.walk(tree) if isinstance(n, ast.Call)
+        ])
+        names = sorted(set([
+            n.id for n in ast.walk(tree) if isinstance(n, ast.Name)
+        ]) - funcs)
+
+        variables = {}
+        for i, name in enumerate(names):
+            shape, dtype = shapes[i % len(shapes)], dtypes[i % len(dtypes)]
+            if shape is None:
+                variables[name] = float(self.rng.rand())
+            else:
+                variables[name] = self.rng.rand(*shape).astype(dtype)
+        for i, name in enumerate(sorted(funcs)):
+            variables[name] = lambda x, i=i: (1.5+i)*x + 0.1*np.mean(x)
+        return variables
+
+    def _check(self, shapes, dtypes):
+        for eq in self.equations:
+            expr = models.Expression(eq)
+            variables = self._variables(eq, shapes, dtypes)
+            goal = eval(eq, dict(variables))
+
+            # a second evaluation reuses the pool, it must not touch the first
+            out0 = expr.evaluate(variables)
+            out1 = expr.evaluate(variables)
+            for out in [out0, out1]:
+                self.assertEqual(np.result_type(out), np.result_type(goal))
+                self.assertTrue(np.allclose(out, goal, rtol=1e-6), eq)
+
+    def test_float64(self):
+        self._check([(4, 5, 6)], [np.float64])
+
+    def test_mixed_dtypes(self):
+        self._check([(4, 5, 6)], [np.float32, np.float64])
+        self._check([(4, 5, 6)], [np.float32])
+
+    def test_broadcast(self):
+        self._check(
+            [(4, 5, 6), (1, 5, 6), None, (4, 1, 1)], [np.float64, np.float32]
+        )
+
+    def test_pool_size(self):
+        eq = 'H(I*(1-P)+C*P) + B'
+        expr = models.Expression(eq)
+        expr.pool_size = 2*4*5*6*8
+
+        for shape in [(4, 5, 6), (3, 5, 6), (2, 5, 6)]:
+            variables = self._variables(eq, [shape, (1, 5, 6)], [np.float64])
+            expr.evaluate(variables)
+            self.assertLessEqual(expr._size, expr.pool_size)
+
+if __name__ == '__main__':
+    unittest.main()
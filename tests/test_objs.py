@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+
+from peri.comp import objs
+from peri.util import Tile
+
+class ExactVolumeTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(10)
+
+    def _draw(self, function, alpha, zscale, rad):
+        """ A particle drawn iteratively and from the table, with its radii """
+        pos = 20 + self.rng.rand(3)
+        r = np.round(np.array([1.0/zscale, 1, 1])*np.ceil(rad) + 4)
+        rvec = Tile(np.round(pos)-r, np.round(pos)+r).coords(form='vector')
+
+        table = objs.ExactVolumeTable(function, (alpha,), zscale=zscale)
+        iterative, rdrawn = objs.exact_volume_sphere(
+            rvec, pos, rad, zscale=zscale, function=function, args=(alpha,),
+            return_radius=True
+        )
+        return iterative, table(rvec, pos, rad), rdrawn, table.radius(rad)
+
+    def test_matches_iterative(self):
+        functions = [
+            (objs.sphere_analytical_gaussian, 0.27595),
+            (objs.sphere_analytical_gaussian_fast, 0.27595),
+            (objs.sphere_constrained_cubic, 0.84990),
+        ]
+        for function, alpha in functions:
+            for zscale in [0.9, 1.0, 1.1]:
+                for rad in [3.0, 4.37, 6.8]:
+                    it, tb, rdrawn, rtable = self._draw(function, alpha, zscale, rad)
+                    self.assertLess(np.abs(it - tb).max(), 2e-2)
+                    self.assertLess(abs(rdrawn - rtable), 1e-2)
+
+    def test_volume(self):
+        for rad in [4.2, 5.5, 7.1]:
+            _, tb, _, _ = self._draw(objs.sphere_analytical_gaussian, 0.27595, 1.0, rad)
+            goal = 4./3*np.pi*rad**3
+            self.assertLess(abs(tb.sum() / goal - 1), 5e-3)
+
+    def test_undraw(self):
+        pos = self.rng.rand(10, 3)*30 + 5
+        rad = self.rng.rand(10) + 4
+        spheres = objs.PlatonicSpheresCollection(
+            pos, rad, shape=Tile(40), exact_volume='table'
+        )
+        particles = spheres.particles.copy()
+
+        params = spheres.param_particle(3)
+        values = spheres.get_values(params)
+        spheres.update(params, np.array(values) + [0.3, -0.2, 0.1, 0.75])
+        spheres.update(params, values)
+        self.assertLess(np.abs(spheres.particles - particles).max(), 1e-12)
+
+    def test_zero_radius(self):
+        table = objs.ExactVolumeTable()
+        rvec = Tile(10).coords(form='vector')
+        self.assertEqual(table.radius(0.0), 0.0)
+        self.assertLess(table(rvec, np.array([5., 5, 5]), 1e-3).sum(), 1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
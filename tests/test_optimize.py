@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+
+from peri.opt import optimize as opt
+from peri.test import init
+
+class _FailingGroups(opt.LMParticleGroupCollection):
+    """ Fails in the second group, after it has changed the model """
+    def _run_group(self, a, mode='1'):
+        stats = super(_FailingGroups, self)._run_group(a, mode=mode)
+        if a == 1:
+            raise RuntimeError('group failed')
+        return stats
+
+class ParticleGroupsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.state = s = init.create_many_particle_state(
+            imsize=48, N=12, radius=4.0, seed=1
+        )
+        params = s.param_particle_pos(np.arange(12))
+        s.update(params, np.array(s.get_values(params)) + 0.1)
+
+    def _check_model(self):
+        s = self.state
+        model, error = s.model.copy(), s.error
+        s.calculate_model()
+        self.assertLess(np.abs(model - s.model).max(), 1e-10)
+        self.assertLess(abs(error - s.error), 1e-10 * s.error)
+
+    def test_processes(self):
+        error = self.state.error
+        lp = opt.LMParticleGroupCollection(
+            self.state, region_size=16, do_calc_size=False, processes=2,
+            max_iter=2
+        )
+        lp.do_run_1()
+
+        self.assertLess(self.state.error, error)
+        self.assertEqual(len(lp.stats), len(lp.particle_groups))
+        self._check_model()
+
+    def test_failure(self):
+        lp = _FailingGroups(
+            self.state, region_size=16, do_calc_size=False, processes=2,
+            max_iter=2
+        )
+        self.assertRaises(RuntimeError, lp.do_run_1)
+        self._check_model()
+
+if __name__ == '__main__':
+    unittest.main()
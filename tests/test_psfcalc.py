@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+
+from peri.comp import psfcalc
+
+class GetKTestCase(unittest.TestCase):
+    """ The integrals tabulated over unique (z, rho) against pointwise sums """
+    def setUp(self):
+        self.factor = psfcalc.K_TABLE_FACTOR
+
+    def tearDown(self):
+        psfcalc.K_TABLE_FACTOR = self.factor
+
+    def _check(self, rho, z):
+        kw = dict(alpha=1.1, zint=50.0, n2n1=0.92)
+        for get_hdet in [False, True]:
+            for K in [1, 2, 3]:
+                psfcalc.K_TABLE_FACTOR = self.factor
+                out, pre = psfcalc.get_K(
+                    rho, z, K=K, get_hdet=get_hdet, return_Kprefactor=True, **kw
+                )
+                psfcalc.K_TABLE_FACTOR = 0
+                goal = psfcalc.get_K(rho, z, K=K, get_hdet=get_hdet, **kw)
+                self.assertEqual(out.shape, rho.shape)
+                self.assertLess(np.abs(out - goal).max(), 1e-13)
+
+                # the prefactor passed back gives the same integrals
+                again = psfcalc.get_K(
+                    rho, z, K=K, get_hdet=get_hdet, Kprefactor=pre, **kw
+                )
+                self.assertLess(np.abs(again - goal).max(), 1e-13)
+
+    def test_grid(self):
+        x, y, z = np.meshgrid(
+            np.arange(-6, 7.), np.arange(-6, 7.), np.linspace(-8, 8, 5),
+            indexing='ij'
+        )
+        self._check(np.sqrt(x**2 + y**2), z)
+
+    def test_scattered(self):
+        rng = np.random.RandomState(10)
+        self._check(10*rng.rand(50), 16*rng.rand(50) - 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import threading
+import numpy as np
+from scipy import ndimage
+
+from peri.util import Tile
+from peri.comp import psfs, exactpsf
+
+def _roll_convolve(field, kernel, center):
+    """
+    Periodic convolution of `field` with `kernel`, whose origin is at the
+    index `center`, as a direct sum over the kernel
+    """
+    out = np.zeros(field.shape)
+    axes = tuple(range(field.ndim))
+    for ind in zip(*np.nonzero(kernel)):
+        shift = tuple(np.array(ind) - center)
+        out += kernel[ind] * np.roll(field, shift, axis=axes)
+    return out
+
+class PSFExecuteTestCase(unittest.TestCase):
+    """
+    The psfs applied to a field on a tile away from the origin of the image,
+    against direct convolutions with the same (z dependent) kernels
+    """
+    def setUp(self):
+        self.rng = np.random.RandomState(10)
+        self.image = Tile(24)
+        self.tile = Tile([2, 3, 1], [24, 19, 21])
+        self.field = self.rng.rand(*self.tile.shape)
+
+    def _execute(self, psf):
+        psf.set_tile(self.tile)
+        return psf.execute(self.field)
+
+    def _check(self, out, goal):
+        self.assertEqual(out.shape, goal.shape)
+        self.assertLess(np.abs(out - goal).max(), 1e-12 * np.abs(goal).max())
+
+    def test_gaussian(self):
+        for psf in [psfs.AnisotropicGaussian(shape=self.image),
+                psfs.AnisotropicGaussianXYZ(shape=self.image)]:
+            out = self._execute(psf)
+
+            kernel = psf.min_rpsf / psf.min_rpsf.sum()
+            goal = _roll_convolve(self.field, kernel, psf.min_support // 2)
+            self._check(out, goal)
+
+    def test_psf4d(self):
+        for psf in [
+                psfs.Gaussian4DPoly(order=(2, 1, 1), zrange=24, shape=self.image),
+                psfs.GaussianMomentExpansion(zrange=24, shape=self.image)]:
+            psf.update(psf.params[1], 0.5)
+            out = self._execute(psf)
+
+            # x-y convolution of each plane with the psf at its z
+            z = np.arange(self.tile.l[0], self.tile.r[0]).astype('float')
+            vecs = psf.rvecs(self.tile)
+            planes = []
+            for i, zp in enumerate(z):
+                kernel = psf.rpsf_xy(vecs, zp).reshape(self.tile.shape[1:])
+                kernel = kernel / kernel.sum()
+                planes.append(_roll_convolve(self.field[i], kernel, 0))
+
+            # then in z over the planes within its size, not periodic
+            goal = np.zeros(self.tile.shape)
+            for i, zp in enumerate(z):
+                size = psf.get_padding_size(tile=None, z=zp).shape[0]
+                m = np.nonzero(np.abs(z - zp) <= size)[0]
+                weights = psf.rpsf_z(z[m], zp)
+                for j, w in zip(m, weights):
+                    goal[i] += w * planes[j]
+            self._check(out, goal)
+
+    def test_exact(self):
+        psf = exactpsf.ExactLineScanConfocalPSF(shape=self.image)
+        out = self._execute(psf)
+
+        # each plane is convolved with the psf at its z, periodic over the tile
+        nz = self.tile.shape[0]
+        goal = np.zeros(self.tile.shape)
+        for i in range(nz):
+            kernel = psf.slices[self.tile.l[0] + i - psf.zrange[0]]
+            kernel = kernel / kernel.sum()
+            c = kernel.shape[0] // 2
+            for m in range(kernel.shape[0]):
+                plane = self.field[(i - m + c) % nz]
+                goal[i] += ndimage.convolve(plane, kernel[m], mode='wrap')
+        self._check(out, goal)
+
+    def test_chebyshev(self):
+        psf = exactpsf.ChebyshevLineScanConfocalPSF(
+            shape=self.image, cheb_degree=3, cheb_evals=5
+        )
+        out = self._execute(psf)
+
+        zc = self.tile.coords(form='flat')[0]
+        goal = np.zeros(self.tile.shape)
+        for k, coeff in enumerate(psf.cheb.coefficients):
+            conv = ndimage.convolve(self.field, coeff, mode='wrap')
+            goal += psf.cheb.tk(k, zc)[:, None, None] * conv
+        self._check(out, goal)
+
+    def test_from_array(self):
+        # an even support, centered at half its size like fftfreq
+        array = self.rng.rand(self.image.shape[0], 4, 6, 6)
+        psf = psfs.FromArray(array)
+        psf.tile = self.tile
+        out = psf.execute(self.field)
+
+        goal = np.zeros(self.tile.shape)
+        for i in range(self.tile.shape[0]):
+            kernel = array[self.tile.l[0] + i]
+            conv = ndimage.convolve(self.field, kernel / kernel.sum(), mode='wrap')
+            goal[i] = conv[i]
+        self._check(out, goal)
+
+    def test_complex(self):
+        """ Transformed fields are not taken for the half spectra """
+        array = psfs.FromArray(self.rng.rand(self.image.shape[0], 4, 6, 6))
+        array.tile = self.tile
+        field = self.field.astype('complex')
+        for psf in [psfs.AnisotropicGaussian(shape=self.image),
+                psfs.Gaussian4DPoly(order=(2, 1, 1), zrange=24, shape=self.image)]:
+            psf.set_tile(self.tile)
+            self.assertRaises(ValueError, psf.execute, field)
+        self.assertRaises(ValueError, array.execute, field)
+
+class ExactPSFSlicesTestCase(unittest.TestCase):
+    def test_processes(self):
+        psf = exactpsf.ExactLineScanConfocalPSF(shape=Tile(16))
+        zs = [0, 3, 7, 12, 15]
+        goal = psf.psf_slices(zs, psf.support, processes=1)
+
+        # in the main thread over processes, in a thread without them
+        out = [psf.psf_slices(zs, psf.support, processes=2)]
+        thread = threading.Thread(target=lambda: out.append(
+            psf.psf_slices(zs, psf.support, processes=2)
+        ))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(len(out), 2)
+        for slices in out:
+            self.assertEqual(len(slices), len(goal))
+            for a, b in zip(slices, goal):
+                self.assertTrue(np.allclose(a, b, rtol=0, atol=1e-15))
+
+class ExactPSFStepTestCase(unittest.TestCase):
+    def test_small_step(self):
+        """
+        A psf updated by steps below the characterization tolerances gives
+        the same output as one loaded afresh at the same parameters
+        """
+        psf = exactpsf.ExactLineScanConfocalPSF(shape=Tile(24))
+        tile = Tile([2, 3, 1], [24, 19, 21])
+        field = np.random.RandomState(10).rand(*tile.shape)
+
+        for param in ['psf-alpha', 'psf-zslab', 'psf-kfki']:
+            value = psf.get_values(param)
+            psf.update(param, value + 9e-5*max(abs(value), 1))
+            psf.set_tile(tile)
+            out = psf.execute(field)
+
+            fresh = pickle.loads(pickle.dumps(psf))
+            fresh.set_tile(tile)
+            self.assertLess(np.abs(out - fresh.execute(field)).max(), 1e-12)
+
+class ExactPSFCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.environ = os.environ.get('PERI_PSF_CACHE')
+        os.environ['PERI_PSF_CACHE'] = self.cachedir
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['PERI_PSF_CACHE']
+        else:
+            os.environ['PERI_PSF_CACHE'] = self.environ
+        shutil.rmtree(self.cachedir)
+
+    def test_round_trip(self):
+        psf = exactpsf.ExactLineScanConfocalPSF(shape=Tile(16))
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        # a second psf at the same parameters loads the saved slices
+        cached = exactpsf.ExactLineScanConfocalPSF(shape=Tile(16))
+        self.assertIsInstance(cached.slices, np.memmap)
+        self.assertTrue(np.array_equal(cached.slices, psf.slices))
+        self.assertTrue(np.array_equal(cached.support, psf.support))
+        self.assertTrue(np.array_equal(cached.drift_poly, psf.drift_poly))
+
+        # another version of the calculation does not
+        cached.cache_version = psf.cache_version + 1
+        self.assertIsNone(cached._load_cache(['slices']))
+
+if __name__ == '__main__':
+    unittest.main()
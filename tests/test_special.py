@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from scipy import special as sp
+
+from peri import special
+from peri.comp import objs
+
+class FastFunctionsTestCase(unittest.TestCase):
+    """
+    The fast approximations against scipy, to the accuracy of the
+    Abramowitz and Stegun formulas they are built on
+    """
+    def test_erf(self):
+        x = np.linspace(-6, 6, 2001)
+        self.assertLess(np.abs(special.fast_erf(x) - sp.erf(x)).max(), 2.5e-5)
+
+    def test_bessel(self):
+        x = np.linspace(1e-3, 60, 5001)
+        functions = [
+            (special.fast_j0, sp.j0), (special.fast_j1, sp.j1),
+            (special.fast_j2, lambda x: sp.jv(2, x))
+        ]
+        for fast, goal in functions:
+            self.assertLess(np.abs(fast(x) - goal(x)).max(), 2e-7)
+
+    def test_sphere_profile(self):
+        dr = np.linspace(-3, 3, 1201)
+        for a in [3.0, 5.0]:
+            fast = objs.sphere_analytical_gaussian_fast(dr, a)
+            goal = objs.sphere_analytical_gaussian(dr, a)
+            self.assertLess(np.abs(fast - goal).max(), 2e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+import unittest
+import numpy as np
+
+from peri import util
+from peri.test import init
+
+def _create_state(comps, args):
+    conf = {'model': 'confocal-dyedfluid', 'comps': comps, 'args': args}
+    s = init.create_many_particle_state(
+        imsize=24, N=3, radius=4.0, seed=10, conf=conf
+    )
+
+    # the polynomials start out as zero, which zeroes many derivatives
+    rng = np.random.RandomState(10)
+    for category in ['ilm', 'bkg']:
+        c = s.get(category)
+        if not hasattr(c, 'randomize_parameters'):
+            s.update(c.params, 0.5 + 0.2*rng.rand(len(c.params)))
+    return s
+
+_POLY_STATE = (
+    {'psf': 'gauss3d', 'ilm': 'poly3d', 'bkg': 'cheb2p1d', 'offset': 'const'},
+    {'ilm': {'order': (2, 2, 2)},
+        'bkg': {'order': (2, 2, 2), 'category': 'bkg'},
+        'offset': {'name': 'offset', 'value': 0}}
+)
+
+class AnalyticGradientTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.poly = _create_state(*_POLY_STATE)
+        cls.barnes = _create_state(
+            {'psf': 'cheb-linescan-fixedss', 'ilm': 'barnesleg2p1d',
+                'bkg': 'leg2p1d', 'offset': 'const'},
+            {'ilm': {'npts': (4, 3), 'zorder': 2},
+                'bkg': {'order': (2, 2, 2), 'category': 'bkg'},
+                'offset': {'name': 'offset', 'value': 0}}
+        )
+
+    def _check(self, s, category, params, tol):
+        """
+        Each analytic derivative of the model wrt `params` against the
+        finite differences of the model
+        """
+        c = s.get(category)
+        for p in params:
+            self.assertIsNotNone(c.get_field_gradient(p), p)
+
+        analytic = s.gradmodel(params=params)
+        numeric = s.gradmodel(params=params, analytic=False, rts=True)
+        for p, a, n in zip(params, analytic, numeric):
+            self.assertGreater(np.abs(n).max(), 0, p)
+            self.assertLess(np.linalg.norm(a - n) / np.linalg.norm(n), tol, p)
+
+    def test_particles(self):
+        s = self.poly
+        self._check(s, 'obj', s.param_particle(np.arange(3)), 1e-3)
+
+    def test_polynomial_ilm(self):
+        self._check(self.poly, 'ilm', self.poly.get('ilm').params, 1e-6)
+
+    def test_polynomial_2p1d(self):
+        self._check(self.poly, 'bkg', self.poly.get('bkg').params, 1e-6)
+        self._check(self.barnes, 'bkg', self.barnes.get('bkg').params, 1e-6)
+
+    def test_barnes_ilm(self):
+        self._check(self.barnes, 'ilm', self.barnes.get('ilm').params, 1e-6)
+
+    def test_chebyshev_coefficients(self):
+        psf = self.barnes.get('psf')
+        psf.coefficient_gradient = True
+        try:
+            params = ['psf-kfki', 'psf-sigkf']
+            self._check(self.barnes, 'psf', params, 1e-4)
+        finally:
+            del psf.coefficient_gradient
+
+    def test_no_rts(self):
+        """
+        The analytic columns are taken at the current values even when
+        earlier finite differences leave the state moved
+        """
+        s0, s1 = [_create_state(*_POLY_STATE) for _ in range(2)]
+        params = s0.get('psf').params[:1] + s0.get('ilm').params[:3]
+        J0, e0 = s0.J_e(params=params, rts=True)
+        J1, e1 = s1.J_e(params=params, rts=False)
+        self.assertTrue(np.allclose(J0[1:], J1[1:], rtol=1e-10, atol=0))
+        self.assertTrue(np.allclose(e0[1:], e1[1:], rtol=1e-10, atol=0))
+
+class ParallelGradientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.states = [_create_state(*_POLY_STATE) for _ in range(2)]
+        s = self.states[0]
+        self.params = s.param_particle([0, 1]) + s.get('ilm').params[:3]
+
+    def test_rts(self):
+        s = self.states[0]
+        for analytic in [True, False]:
+            kw = dict(params=self.params, rts=True, analytic=analytic)
+            self.assertTrue(np.allclose(s.J(**kw), s.J(workers=2, **kw)))
+
+            J0, e0 = s.J_e(**kw)
+            J1, e1 = s.J_e(workers=2, **kw)
+            self.assertTrue(np.allclose(J0, J1))
+            self.assertTrue(np.allclose(e0, e1))
+
+    def test_no_rts(self):
+        """ Without rts the state moves the same way with or without workers """
+        s0, s1 = self.states
+        kw = dict(params=self.params, rts=False, analytic=False)
+        J0, e0 = s0.J_e(**kw)
+        J1, e1 = s1.J_e(workers=2, **kw)
+        self.assertTrue(np.allclose(J0, J1, rtol=1e-3, atol=1e-6))
+        self.assertTrue(np.allclose(e0, e1, rtol=1e-3))
+
+        self.assertTrue(np.allclose(
+            s0.get_values(self.params), s1.get_values(self.params),
+            rtol=0, atol=1e-12
+        ))
+        self.assertLess(np.abs(s0.model - s1.model).max(), 1e-10)
+        self.assertLess(abs(s0.error - s1.error), 1e-10 * s0.error)
+
+class BatchGradientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.states = [_create_state(*_POLY_STATE) for _ in range(2)]
+        s = self.states[0]
+        self.params = s.param_particle(np.arange(3)) + s.get('ilm').params[:3]
+
+    def test_rts(self):
+        s = self.states[0]
+        kw = dict(params=self.params, rts=True, analytic=False)
+        J0, e0 = s.J_e(**kw)
+        J1, e1 = s.J_e(batch=True, **kw)
+        self.assertTrue(np.allclose(J0, J1, rtol=1e-8, atol=1e-10))
+        self.assertTrue(np.allclose(e0, e1, rtol=1e-6, atol=1e-10))
+        self.assertTrue(np.allclose(s.J(batch=True, **kw), J0, atol=1e-10))
+
+    def test_no_rts(self):
+        """ Without rts the running model and error follow the batches """
+        s0, s1 = self.states
+        kw = dict(params=self.params, rts=False, analytic=False)
+        J0 = s0.J(**kw)
+        J1 = s1.J(batch=True, **kw)
+        self.assertTrue(np.allclose(J0, J1, rtol=1e-3, atol=1e-6))
+
+        model, error = s1.model.copy(), s1.error
+        s1.calculate_model()
+        self.assertLess(np.abs(model - s1.model).max(), 1e-10)
+        self.assertLess(abs(error - s1.error), 1e-10 * s1.error)
+        self.assertLess(np.abs(s0.model - s1.model).max(), 1e-10)
+
+class RunningErrorTestCase(unittest.TestCase):
+    def test_updates(self):
+        s = _create_state(*_POLY_STATE)
+        rng = np.random.RandomState(11)
+
+        def perturb(params, scale):
+            values = np.array(s.get_values(params))
+            s.update(params, values + scale*rng.randn(len(params)))
+
+        for _ in range(3):
+            perturb(s.param_particle(0), 0.3)
+            perturb(s.param_particle_rad([1, 2]), 0.2)
+            perturb(s.get('ilm').params[:4], 0.05)
+            perturb(s.get('bkg').params, 0.05)
+            perturb(s.get('psf').params[:1], 0.1)
+            perturb(['offset'], 0.05)
+
+        error, loglikelihood = s.error, s.loglikelihood
+        s.calculate_model()
+        self.assertLess(abs(error - s.error), 1e-10 * s.error)
+        self.assertLess(
+            abs(loglikelihood - s.loglikelihood), 1e-10 * abs(s.loglikelihood)
+        )
+
+class QuantizeTileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.state = s = _create_state(*_POLY_STATE)
+        s.tile_sizes = util.fft_sizes(max(s.oshape.shape))
+
+    def test_contains(self):
+        s = self.state
+        sizes = s.tile_sizes + list(s.oshape.shape)
+        rng = np.random.RandomState(10)
+        for _ in range(200):
+            l = rng.randint(0, s.oshape.shape)
+            r = l + 1 + rng.randint(0, s.oshape.shape - l)
+            tile = util.Tile(l, r)
+            out = s._quantize_tile(tile)
+
+            self.assertEqual(util.Tile.intersection(out, tile), tile)
+            self.assertEqual(util.Tile.intersection(out, s.oshape), out)
+            for size in out.shape:
+                self.assertIn(size, sizes)
+
+    def test_updates(self):
+        s = self.state
+        params = s.param_particle(np.arange(3))
+        s.update(params, np.array(s.get_values(params)) + 0.3)
+
+        error = s.error
+        s.calculate_model()
+        self.assertLess(abs(error - s.error), 1e-10 * s.error)
+
+if __name__ == '__main__':
+    unittest.main()